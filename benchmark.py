@@ -0,0 +1,236 @@
+# Benchmark of the transcription hot path: image encoding, request building and the bulk
+# loop, run against the local mock Messages endpoint so no API credits are spent.
+#
+# Example:
+#     python benchmark.py --resolutions 1200x1600,2400x3200 --history 0,4 --concurrency 1,8 --latency 0.2
+#
+# Every combination of page resolution, training history length and concurrency is run as
+# a scenario in its own process, so the peak RSS reported is that of the scenario alone.
+# Results can be saved with --output and checked against an earlier run with --baseline;
+# the exit status is 1 if any scenario got worse by more than the tolerance.
+
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import anthropic
+from PIL import Image, ImageDraw
+
+import transcription_core as core
+from mock_anthropic import MockAnthropicServer
+
+# Text of the synthetic training iterations, roughly the length of a transcribed page
+HISTORY_TEXT = "Anno 1742 den 3 maj infann sig i rätten bonden Per Olsson ifrån Backa by. " * 20
+
+# Measurements compared against a baseline, and whether a higher value is better
+BASELINE_FIELDS = {
+    "pages_per_second": True,
+    "latency_p95": False,
+    "payload_bytes_per_page": False,
+    "encode_ms_per_page": False,
+    "peak_rss_mb": False
+}
+
+# Parse a comma-separated list of WIDTHxHEIGHT resolutions
+def parse_resolutions(text):
+    return [tuple(int(side) for side in item.lower().split("x")) for item in text.split(",")]
+
+# Parse a comma-separated list of integers
+def parse_counts(text):
+    return [int(item) for item in text.split(",")]
+
+# Draw a page that compresses roughly like a scanned manuscript: paper noise and rows of strokes
+def synthetic_page(width, height, seed):
+    rng = random.Random(seed)
+    image = Image.effect_noise((width, height), 12).point(lambda value: 205 + value // 8).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    line_height = max(20, height // 40)
+    stroke = max(1, width // 600)
+    for y in range(line_height, height - line_height, line_height):
+        x = rng.randint(width // 20, width // 10)
+        while x < width * 0.9:
+            word = rng.randint(width // 40, width // 12)
+            points = [(x + step * word / 8, y + rng.randint(-line_height // 4, line_height // 4)) for step in range(9)]
+            draw.line(points, fill=(40, 30, 25), width=stroke)
+            x += word + rng.randint(width // 80, width // 30)
+    return image
+
+# Write the benchmark pages of every resolution to a directory, as JPEG like most scans
+def write_pages(directory, resolutions, count):
+    pages = {}
+    for width, height in resolutions:
+        paths = []
+        for index in range(count):
+            path = os.path.join(directory, f"sida_{width}x{height}_{index}.jpg")
+            synthetic_page(width, height, seed=index).save(path, quality=90)
+            paths.append(path)
+        pages[f"{width}x{height}"] = paths
+    return pages
+
+# Build a training history of completed iterations on pages of the given size
+def synthetic_history(length, width, height, prompt, preprocessing):
+    iterations = []
+    for index in range(length):
+        _, user_message = core.build_transcription_messages(
+            synthetic_page(width, height, seed=1000 + index),
+            prompt,
+            [],
+            preprocessing=preprocessing
+        )
+        iteration = core.new_iteration(user_message, prompt, HISTORY_TEXT)
+        iteration["correction"] = HISTORY_TEXT
+        iteration["reflection"] = "Jag läste flera ord fel i den andra raden."
+        iterations.append(iteration)
+    return core.render_iterations(iterations)
+
+# Peak resident set size of this process in MB
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# Run one scenario in this process and return its measurements
+def run_scenario(scenario):
+    width, height = scenario["resolution"]
+    preprocessing = dict(core.DEFAULT_PREPROCESSING)
+    client = anthropic.Anthropic(api_key="benchmark", base_url=scenario["base_url"])
+    history = synthetic_history(scenario["history"], width, height, core.DEFAULT_PROMPT, preprocessing)
+    pages = [(path, path) for path in scenario["pages"]]
+
+    started = time.perf_counter()
+    errors = 0
+    for _, _, error in core.run_bulk_transcription(
+        pages,
+        core.DEFAULT_PROMPT,
+        history,
+        client,
+        max_concurrency=scenario["concurrency"],
+        cache_history=True,
+        preprocessing=preprocessing
+    ):
+        if error is not None:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    summary = core.get_metrics().summary()
+    return {
+        "resolution": f"{width}x{height}",
+        "history": scenario["history"],
+        "concurrency": scenario["concurrency"],
+        "pages": len(pages),
+        "errors": errors,
+        "seconds": elapsed,
+        "pages_per_second": len(pages) / elapsed,
+        "latency_p50": summary["latency_p50"],
+        "latency_p95": summary["latency_p95"],
+        "payload_bytes_per_page": summary["payload_bytes_mean"],
+        "encode_ms_per_page": summary["encode_seconds_mean"] * 1000,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+# Run a scenario in a fresh Python process so its memory use is measured on its own
+def run_scenario_process(scenario):
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-scenario", json.dumps(scenario)],
+        capture_output=True,
+        text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Scenariot misslyckades:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def print_results(results):
+    print(f"{'upplösning':>11} {'historik':>8} {'samtid.':>7} {'sidor/s':>8} {'p50 s':>6} {'p95 s':>6} {'kB/sida':>8} {'kodning ms':>10} {'topp-RSS MB':>11} {'fel':>4}")
+    for result in results:
+        print(
+            f"{result['resolution']:>11} {result['history']:>8} {result['concurrency']:>7} "
+            f"{result['pages_per_second']:>8.2f} {result['latency_p50'] or 0:>6.2f} {result['latency_p95'] or 0:>6.2f} "
+            f"{result['payload_bytes_per_page'] / 1024:>8.0f} {result['encode_ms_per_page']:>10.1f} "
+            f"{result['peak_rss_mb']:>11.0f} {result['errors']:>4}"
+        )
+
+# Compare results with a baseline run and return descriptions of the regressions
+def find_regressions(results, baseline, tolerance):
+    baseline_by_scenario = {
+        (entry["resolution"], entry["history"], entry["concurrency"]): entry
+        for entry in baseline
+    }
+    regressions = []
+    for result in results:
+        before = baseline_by_scenario.get((result["resolution"], result["history"], result["concurrency"]))
+        if before is None:
+            continue
+        for field, higher_is_better in BASELINE_FIELDS.items():
+            if not before[field] or result[field] is None:
+                continue
+            change = (result[field] - before[field]) / before[field]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{result['resolution']}, historik {result['history']}, samtidighet {result['concurrency']}: "
+                    f"{field} {before[field]:.2f} -> {result[field]:.2f} ({change:+.0%})"
+                )
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mät kodning, förfrågningsbygge och bulk-genomströmning mot en lokal fejkserver.")
+    parser.add_argument("--resolutions", type=parse_resolutions, default=parse_resolutions("1000x1400,2000x2800,4000x5600"), help="Sidupplösningar, t.ex. 1000x1400,4000x5600.")
+    parser.add_argument("--history", type=parse_counts, default=[0, 4], help="Antal träningsiterationer i historiken, t.ex. 0,4.")
+    parser.add_argument("--concurrency", type=parse_counts, default=[1, 8], help="Antal samtidiga anrop, t.ex. 1,8.")
+    parser.add_argument("--pages", type=int, default=16, help="Antal sidor per scenario.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Fejkserverns fördröjning per anrop i sekunder.")
+    parser.add_argument("--output", help="Spara resultaten som JSON.")
+    parser.add_argument("--baseline", help="Jämför med resultat sparade med --output från en tidigare körning.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Tillåten försämring mot baslinjen (andel).")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(json.loads(args.run_scenario))))
+        return 0
+
+    server = MockAnthropicServer(latency=args.latency).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="transkription_benchmark_") as directory:
+            print(f"Skapar {args.pages} testsidor per upplösning...", file=sys.stderr)
+            pages = write_pages(directory, args.resolutions, args.pages)
+            for (width, height), history, concurrency in itertools.product(args.resolutions, args.history, args.concurrency):
+                print(f"Kör {width}x{height}, historik {history}, samtidighet {concurrency}...", file=sys.stderr)
+                results.append(run_scenario_process({
+                    "base_url": server.base_url,
+                    "resolution": [width, height],
+                    "history": history,
+                    "concurrency": concurrency,
+                    "pages": pages[f"{width}x{height}"]
+                }))
+    finally:
+        server.stop()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Försämringar mot baslinjen:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            return 1
+        print("Inga försämringar mot baslinjen.", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
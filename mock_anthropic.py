@@ -0,0 +1,347 @@
+# Local stand-in for the Anthropic Messages and Message Batches endpoints, used to
+# run the app, the CLI and batch jobs offline without spending API credits.
+#
+#     python mock_anthropic.py --port 8765 --latency 0.5
+#     ANTHROPIC_API_KEY=test ANTHROPIC_BASE_URL=http://127.0.0.1:8765 python transcribe_cli.py ...
+#
+# The server can also be started in-process with MockAnthropicServer(...).start().
+#
+# Faults can be injected into the Messages endpoint to test retries and the circuit breaker:
+#
+#     python mock_anthropic.py --outage 10 --error-rate 0.2 --stall-rate 0.05 --stall-seconds 30
+#
+# fails the first 10 requests, then a random 20% of them, and leaves 5% unanswered for 30 seconds.
+# With --uncertain-rate, that share of the responses to prompts asking for uncertainty markers
+# contain one, so the escalation of a model cascade can be tested.
+
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Format a timestamp the way the API does
+def api_timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat().replace("+00:00", "Z")
+
+class MockAnthropicServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, batch_delay=1.0, response_words=0, outage=0, error_rate=0.0, error_status=529, stall_rate=0.0, stall_seconds=30.0, uncertain_rate=0.0, seed=None):
+        super().__init__((host, port), MockAnthropicHandler)
+        self.latency = latency
+        self.response_words = response_words
+        self.batch_delay = batch_delay
+        self.outage = outage
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.uncertain_rate = uncertain_rate
+        self.random = random.Random(seed)
+        self.batches = {}
+        self.cached_prefixes = set()
+        self.message_count = 0
+        self.request_count = 0
+        self.faults = {"error": 0, "stall": 0}
+        self.lock = threading.RLock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # Serve requests on a background thread
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Clients that gave up on a stalled request have already closed the connection
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    # Decide whether a Messages request fails: "error", "stall" or None.
+    # The first outage requests fail, the rest fail at random at the configured rates.
+    def inject_fault(self):
+        with self.lock:
+            self.request_count += 1
+            if self.request_count <= self.outage:
+                fault = "error"
+            else:
+                draw = self.random.random()
+                if draw < self.error_rate:
+                    fault = "error"
+                elif draw < self.error_rate + self.stall_rate:
+                    fault = "stall"
+                else:
+                    return None
+            self.faults[fault] += 1
+        return fault
+
+    # Build a message response for a Messages API request body.
+    # Every word of the text counts as one output token, so responses longer than
+    # max_tokens are cut off and can be continued by prefilling the partial text.
+    def create_message(self, body):
+        with self.lock:
+            self.message_count += 1
+
+        messages = body["messages"]
+        prefill = ""
+        if messages[-1]["role"] == "assistant":
+            prefill = messages[-1]["content"]
+            messages = messages[:-1]
+
+        image_bytes = sum(
+            len(block["source"].get("data", ""))
+            for block in messages[-1]["content"]
+            if isinstance(block, dict) and block.get("type") == "image"
+        ) if isinstance(messages[-1]["content"], list) else 0
+        words = f"Mock-transkription ({image_bytes} byte bilddata)".split(" ") + ["rad"] * self.response_words
+        
+        # Mark a word as uncertain when the prompt asks for markers
+        prompt = " ".join(
+            block["text"] for block in messages[-1]["content"]
+            if isinstance(block, dict) and block.get("type") == "text"
+        ) if isinstance(messages[-1]["content"], list) else messages[-1]["content"]
+        if "[?]" in prompt:
+            with self.lock:
+                uncertain = self.random.random() < self.uncertain_rate
+            if uncertain:
+                words.insert(1, "[?]")
+
+        # Continue after the words that were prefilled
+        remaining = words[len(prefill.split()):]
+        stop_reason = "end_turn"
+        if len(remaining) > body["max_tokens"]:
+            remaining = remaining[:body["max_tokens"]]
+            stop_reason = "max_tokens"
+        text = " ".join(remaining)
+        if prefill:
+            text = " " + text
+
+        # Report the prefix up to the last cache breakpoint as written once and read afterwards
+        cache_read, cache_write = 0, 0
+        cached_messages = [
+            index for index, message in enumerate(messages)
+            if isinstance(message["content"], list)
+            and any(isinstance(block, dict) and "cache_control" in block for block in message["content"])
+        ]
+        if cached_messages:
+            prefix = json.dumps(messages[:cached_messages[-1] + 1], sort_keys=True)
+            prefix_tokens = len(prefix) // 4
+            with self.lock:
+                if prefix in self.cached_prefixes:
+                    cache_read = prefix_tokens
+                else:
+                    self.cached_prefixes.add(prefix)
+                    cache_write = prefix_tokens
+        input_tokens = max(1, len(json.dumps(messages)) // 4 - cache_read - cache_write)
+
+        return {
+            "id": f"msg_mock_{self.message_count}",
+            "type": "message",
+            "role": "assistant",
+            "model": body["model"],
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": len(remaining),
+                "cache_read_input_tokens": cache_read,
+                "cache_creation_input_tokens": cache_write
+            }
+        }
+
+    def create_batch(self, body):
+        with self.lock:
+            batch_id = f"msgbatch_mock_{hashlib.sha256(str(time.time()).encode()).hexdigest()[:16]}"
+            self.batches[batch_id] = {
+                "created": time.time(),
+                "requests": body["requests"],
+                "results": None,
+                "cancelled_at": None
+            }
+        return self.batch_object(batch_id)
+
+    # Cancel a batch; its unprocessed requests end as canceled right away
+    def cancel_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        with self.lock:
+            if batch["results"] is None:
+                batch["cancelled_at"] = time.time()
+                batch["results"] = [
+                    {"custom_id": request["custom_id"], "result": {"type": "canceled"}}
+                    for request in batch["requests"]
+                ]
+        return self.batch_object(batch_id)
+
+    # Describe a batch; it ends batch_delay seconds after it was created, or when it is cancelled
+    def batch_object(self, batch_id):
+        batch = self.batches[batch_id]
+        ended = batch["cancelled_at"] is not None or time.time() >= batch["created"] + self.batch_delay
+        with self.lock:
+            if ended and batch["results"] is None:
+                batch["results"] = [
+                    {
+                        "custom_id": request["custom_id"],
+                        "result": {"type": "succeeded", "message": self.create_message(request["params"])}
+                    }
+                    for request in batch["requests"]
+                ]
+        count = len(batch["requests"])
+        canceled = count if batch["cancelled_at"] is not None else 0
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else count,
+                "succeeded": count - canceled if ended else 0,
+                "errored": 0,
+                "canceled": canceled,
+                "expired": 0
+            },
+            "created_at": api_timestamp(batch["created"]),
+            "expires_at": api_timestamp(batch["created"] + timedelta(days=1).total_seconds()),
+            "ended_at": api_timestamp(batch["cancelled_at"] or batch["created"] + self.batch_delay) if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": api_timestamp(batch["cancelled_at"]) if batch["cancelled_at"] is not None else None,
+            "results_url": f"{self.base_url}/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+class MockAnthropicHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_not_found(self):
+        self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+    # Send an API error with the error type the API uses for the status code
+    def send_error_response(self, status):
+        error_types = {429: "rate_limit_error", 529: "overloaded_error"}
+        self.send_json(status, {"type": "error", "error": {"type": error_types.get(status, "api_error"), "message": "Injicerat fel"}})
+
+    # Send a message as server-sent events, one text delta per word
+    def send_message_stream(self, message):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("cache-control", "no-cache")
+        self.end_headers()
+
+        def send_event(event_type, data):
+            self.wfile.write(f"event: {event_type}\ndata: {json.dumps({'type': event_type, **data})}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        text = message["content"][0]["text"]
+        send_event("message_start", {"message": {**message, "content": [], "stop_reason": None, "usage": {**message["usage"], "output_tokens": 1}}})
+        send_event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        for index, word in enumerate(text.split(" ")):
+            piece = word if index == 0 else " " + word
+            send_event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": piece}})
+        send_event("content_block_stop", {"index": 0})
+        send_event("message_delta", {"delta": {"stop_reason": message["stop_reason"], "stop_sequence": None}, "usage": {"output_tokens": message["usage"]["output_tokens"]}})
+        send_event("message_stop", {})
+        self.close_connection = True
+
+    def do_POST(self):
+        # Cancelling a batch is a POST without a body
+        data = self.rfile.read(int(self.headers.get("content-length") or 0))
+        body = json.loads(data) if data else {}
+        path = self.path.split("?")[0]
+        if path == "/v1/messages":
+            fault = self.server.inject_fault()
+            if fault == "stall":
+                time.sleep(self.server.stall_seconds)
+            time.sleep(self.server.latency)
+            if fault == "error":
+                self.send_error_response(self.server.error_status)
+                return
+            message = self.server.create_message(body)
+            if body.get("stream"):
+                self.send_message_stream(message)
+            else:
+                self.send_json(200, message)
+        elif path == "/v1/messages/batches":
+            self.send_json(200, self.server.create_batch(body))
+        elif path.startswith("/v1/messages/batches/") and path.endswith("/cancel"):
+            batch_id = path.split("/")[4]
+            if batch_id not in self.server.batches:
+                self.send_not_found()
+                return
+            self.send_json(200, self.server.cancel_batch(batch_id))
+        else:
+            self.send_not_found()
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) < 4 or parts[:3] != ["v1", "messages", "batches"] or parts[3] not in self.server.batches:
+            self.send_not_found()
+            return
+
+        batch = self.server.batch_object(parts[3])
+        if len(parts) == 4:
+            self.send_json(200, batch)
+        elif parts[4:] == ["results"] and batch["processing_status"] == "ended":
+            data = "".join(json.dumps(entry) + "\n" for entry in self.server.batches[parts[3]]["results"]).encode("utf-8")
+            self.send_response(200)
+            self.send_header("content-type", "application/binary")
+            self.send_header("content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_not_found()
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokal fejkserver för Anthropic Messages och Message Batches.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Fördröjning per anrop i sekunder.")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Sekunder tills en batch är klar.")
+    parser.add_argument("--response-words", type=int, default=0, help="Extra ord i varje svar, för att testa max_tokens.")
+    parser.add_argument("--outage", type=int, default=0, help="Antal inledande anrop som misslyckas, för att simulera ett avbrott.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Andel anrop som misslyckas slumpmässigt.")
+    parser.add_argument("--error-status", type=int, default=529, help="HTTP-status för injicerade fel (t.ex. 429, 500, 529).")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Andel anrop som blir hängande, för att testa tidsgränser.")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="Hur länge hängande anrop dröjer.")
+    parser.add_argument("--uncertain-rate", type=float, default=0.0, help="Andel svar med en osäkerhetsmarkering när prompten ber om sådana.")
+    parser.add_argument("--seed", type=int, help="Slumpfrö för injicerade fel.")
+    args = parser.parse_args()
+
+    server = MockAnthropicServer(
+        args.host,
+        args.port,
+        latency=args.latency,
+        batch_delay=args.batch_delay,
+        response_words=args.response_words,
+        outage=args.outage,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds,
+        uncertain_rate=args.uncertain_rate,
+        seed=args.seed
+    )
+    print(f"Fejkserver startad på {server.base_url}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import anthropic
+import pytest
+from PIL import Image
+
+# The modules live in the repository root, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcription_core as core
+from mock_anthropic import MockAnthropicServer
+
+# Start a local fake Messages endpoint; tests change its fault settings as needed
+@pytest.fixture
+def mock_server():
+    server = MockAnthropicServer(batch_delay=0.2).start()
+    yield server
+    server.stop()
+
+# A client for the fake endpoint that fails fast instead of retrying on its own
+@pytest.fixture
+def client(mock_server):
+    return anthropic.Anthropic(api_key="test", base_url=mock_server.base_url, max_retries=0, timeout=5.0)
+
+# A fresh metrics recorder for every test, so counts do not leak between them
+@pytest.fixture(autouse=True)
+def metrics(monkeypatch):
+    recorder = core.MetricsRecorder()
+    monkeypatch.setattr(core, "get_metrics", lambda: recorder)
+    return recorder
+
+# Write small page images to a directory and return (name, path) pairs in upload order.
+# Each page is a little wider than the one before, so their image data differ in size.
+@pytest.fixture
+def page_files(tmp_path):
+    def write(count, size=(400, 600)):
+        pages = []
+        for index in range(count):
+            path = tmp_path / f"sida_{index}.png"
+            Image.new("RGB", (size[0] + index * 40, size[1]), (255 - index * 10, 240, 230)).save(path)
+            pages.append((path.name, str(path)))
+        return pages
+    return write
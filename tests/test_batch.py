@@ -0,0 +1,76 @@
+import transcription_core as core
+
+
+def image_data_size(path):
+    with core.open_page(path) as image:
+        _, user_message = core.build_transcription_messages(image, "p", [])
+    return len(user_message["content"][0]["source"]["data"])
+
+
+def test_batch_results_are_mapped_to_their_pages(client, page_files):
+    pages = page_files(3)
+
+    results = list(core.run_batch_transcription(pages, "p", [], client, poll_interval=0.05))
+
+    assert sorted(i for i, _, _ in results) == [0, 1, 2]
+    for i, result, error in results:
+        assert error is None
+        # The mock answers with the amount of image data it received
+        assert f"({image_data_size(pages[i][1])} byte bilddata)" in result["transcription"]
+        assert core.bulk_result_row(pages[i][0], result, error)["filename"] == pages[i][0]
+
+
+def test_journal_skips_pages_done_before_resume(mock_server, client, page_files, tmp_path):
+    pages = page_files(2)
+    journal = core.JobJournal(str(tmp_path / "journal.sqlite"))
+
+    first = list(core.run_batch_transcription(pages, "p", [], client, journal=journal, poll_interval=0.05))
+    second = list(core.run_batch_transcription(pages, "p", [], client, journal=journal, poll_interval=0.05))
+
+    assert not any(result.get("resumed") for _, result, _ in first)
+    assert all(result["resumed"] for _, result, _ in second)
+    assert len(mock_server.batches) == 1
+
+
+def test_pages_cut_off_at_max_tokens_are_continued(mock_server, client, page_files):
+    mock_server.response_words = 25
+    limits = {"max_tokens": 10, "max_continuations": 3}
+
+    results = list(core.run_batch_transcription(page_files(1), "p", [], client, output_limits=limits, poll_interval=0.05))
+
+    _, result, error = results[0]
+    assert error is None
+    assert result["continuations"] == 2
+    assert not result["truncated"]
+    assert result["transcription"].split().count("rad") == 25
+
+
+def test_failing_continuation_keeps_the_batch_result(mock_server, client, page_files, metrics):
+    mock_server.response_words = 25
+    mock_server.error_rate = 1.0
+    limits = {"max_tokens": 10, "max_continuations": 3}
+    retries = {**core.DEFAULT_RETRY_POLICY, "max_attempts": 2, "base_delay": 0.01, "max_delay": 0.05, "breaker_threshold": 0}
+
+    results = list(core.run_batch_transcription(page_files(3), "p", [], client, output_limits=limits, poll_interval=0.05, retry_policy=retries))
+
+    assert sorted(i for i, _, _ in results) == [0, 1, 2]
+    for _, result, error in results:
+        assert error is None
+        assert result["truncated"]
+        assert len(result["transcription"].split()) == 10
+    assert [entry["status"] for entry in metrics.recent if entry["kind"] == "continuation"] == ["529"] * 6
+
+
+def test_continuations_are_priced_as_regular_calls(mock_server, client, page_files, metrics):
+    mock_server.response_words = 25
+    limits = {"max_tokens": 10, "max_continuations": 3}
+
+    list(core.run_batch_transcription(page_files(1), "p", [], client, output_limits=limits, poll_interval=0.05))
+
+    entries = {entry["kind"]: entry for entry in metrics.recent}
+    assert entries["batch"]["api_calls"] == 1
+    assert entries["batch"]["output_tokens"] == 10
+    assert entries["continuation"]["api_calls"] == 2
+    assert entries["continuation"]["cost_usd"] == core.estimate_cost(
+        {key: entries["continuation"][key] for key in ["input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens"]}
+    )
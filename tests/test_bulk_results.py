@@ -0,0 +1,53 @@
+import csv
+import json
+
+import transcription_core as core
+
+
+USAGE = {"input_tokens": 1, "output_tokens": 1, "cache_read_tokens": 0, "cache_write_tokens": 0}
+
+
+def test_rows_are_written_as_they_arrive(tmp_path):
+    path = str(tmp_path / "results.csv")
+    writer = core.ResultWriter(path)
+    for i in [2, 3, 1]:
+        writer.write(core.bulk_result_row(f"sida_{i}.png", {"transcription": str(i), "usage": USAGE}, position=i + 1))
+
+    # Nothing waits for the first page, which has not finished yet
+    with open(path, encoding="utf-8") as f:
+        assert [row["position"] for row in csv.DictReader(f)] == ["3", "4", "2"]
+    writer.close()
+
+
+def test_rows_are_read_back_in_upload_order(tmp_path):
+    path = str(tmp_path / "results.csv")
+    writer = core.ResultWriter(path)
+    for i in [2, 0, 3, 1]:
+        writer.write(core.bulk_result_row(f"sida_{i}.png", {"transcription": str(i), "usage": USAGE}, position=i + 1))
+    writer.close()
+
+    rows = core.read_result_rows(path)
+    assert [row["filename"] for row in rows] == [f"sida_{i}.png" for i in range(4)]
+    assert [row["position"] for row in core.read_result_rows(path, limit=2)] == ["1", "2"]
+
+
+def test_json_lines_are_read_back_in_upload_order(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    writer = core.ResultWriter(path)
+    writer.write(core.bulk_result_row("sida_2.png", None, RuntimeError("fel"), position=3))
+    writer.write(core.bulk_result_row("sida_0.png", None, RuntimeError("fel"), position=1))
+    writer.close()
+
+    with open(path, encoding="utf-8") as f:
+        assert [json.loads(line)["position"] for line in f] == [3, 1]
+    assert [row["position"] for row in core.read_result_rows(path)] == [1, 3]
+
+
+def test_bulk_pages_stay_out_of_the_process_wide_encoding_cache(client, page_files, monkeypatch):
+    shared = core.EncodedImageCache(core.ENCODING_CACHE_MAX_BYTES)
+    monkeypatch.setattr(core, "_encoding_cache", shared)
+
+    results = list(core.run_bulk_transcription(page_files(3), "p", [], client, max_concurrency=2))
+
+    assert all(error is None for _, _, error in results)
+    assert shared.stats()["entries"] == 0
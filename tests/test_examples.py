@@ -0,0 +1,49 @@
+from PIL import Image, ImageDraw
+
+import transcription_core as core
+
+
+# A page with either plain lines or a ruled table, so the two kinds look different
+def page(kind, shade):
+    image = Image.new("RGB", (300, 400), (shade, shade, shade - 10))
+    draw = ImageDraw.Draw(image)
+    for y in range(20, 400, 24):
+        draw.line([(20, y), (280, y)], fill=(40, 30, 20), width=2)
+    if kind == "table":
+        for x in range(0, 300, 60):
+            draw.line([(x, 0), (x, 400)], fill=(0, 0, 0), width=8)
+    return image
+
+
+def training_iterations():
+    iterations = []
+    for index, kind in enumerate(["plain", "table"] * 3):
+        _, user_message = core.build_transcription_messages(page(kind, 230 + index), "p", [])
+        iteration = core.new_iteration(user_message, "p", kind)
+        iteration["correction"] = kind
+        iteration["reflection"] = "r"
+        iterations.append(iteration)
+    return iterations
+
+
+def test_hashes_are_computed_on_first_selection(monkeypatch):
+    monkeypatch.setattr(core, "_iteration_hashes", {})
+    decoded = []
+    open_iteration_image = core.open_iteration_image
+    monkeypatch.setattr(core, "open_iteration_image", lambda *args: decoded.append(1) or open_iteration_image(*args))
+    policy = {**core.DEFAULT_HISTORY_POLICY, "mode": "similar", "keep_iterations": 2}
+
+    selector = core.ExampleSelector(training_iterations(), policy, "p")
+    assert decoded == []
+
+    selector.history(page("table", 240))
+    selector.history(page("plain", 240))
+    assert len(decoded) == 6
+
+
+def test_most_similar_iterations_are_selected():
+    policy = {**core.DEFAULT_HISTORY_POLICY, "mode": "similar", "keep_iterations": 3}
+    selector = core.ExampleSelector(training_iterations(), policy, "p")
+
+    for kind in ["plain", "table"]:
+        assert [iteration["correction"] for iteration in selector.select(page(kind, 225))] == [kind] * 3
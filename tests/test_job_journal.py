@@ -0,0 +1,58 @@
+import transcription_core as core
+
+
+def run(pages, client, journal, max_tokens):
+    limits = {"max_tokens": max_tokens, "max_continuations": 0}
+    return [
+        result
+        for _, result, _ in core.run_bulk_transcription(pages, "p", [], client, journal=journal, output_limits=limits)
+    ]
+
+
+def test_resumed_pages_keep_their_results(client, page_files, tmp_path):
+    pages = page_files(2)
+    journal = core.JobJournal(str(tmp_path / "journal.sqlite"))
+
+    first = run(pages, client, journal, 1000)
+    second = run(pages, client, journal, 1000)
+
+    assert not any(result.get("resumed") for result in first)
+    assert all(result["resumed"] for result in second)
+
+
+def test_higher_token_limit_reruns_truncated_pages(mock_server, client, page_files, tmp_path):
+    pages = page_files(2)
+    journal = core.JobJournal(str(tmp_path / "journal.sqlite"))
+
+    truncated = run(pages, client, journal, 2)
+    rerun = run(pages, client, journal, 1000)
+
+    assert all(result["truncated"] for result in truncated)
+    assert not any(result["truncated"] or result.get("resumed") for result in rerun)
+    assert mock_server.message_count == 4
+
+
+def test_summary_history_is_resumed_after_a_restart(mock_server, client, page_files, tmp_path):
+    pages = page_files(2)
+    journal = core.JobJournal(str(tmp_path / "journal.sqlite"))
+    iterations = []
+    for name, path in page_files(3):
+        with core.open_page(path) as image:
+            _, user_message = core.build_transcription_messages(image, "p", [])
+        iteration = core.new_iteration(user_message, "p", name)
+        iteration["correction"] = name.upper()
+        iteration["reflection"] = "r"
+        iterations.append(iteration)
+    policy = {**core.DEFAULT_HISTORY_POLICY, "mode": "summary", "keep_iterations": 1}
+    history_key = core.history_fingerprint(iterations, policy)
+
+    # Every run summarizes the older iterations anew, and the model words the summary differently
+    first_history = core.apply_history_policy(iterations, policy, "p", client)
+    first = list(core.run_bulk_transcription(pages, "p", first_history, client, journal=journal, history_key=history_key))
+    mock_server.response_words = 3
+    second_history = core.apply_history_policy(iterations, policy, "p", client)
+    second = list(core.run_bulk_transcription(pages, "p", second_history, client, journal=journal, history_key=history_key))
+
+    assert first_history != second_history
+    assert not any(result.get("resumed") for _, result, _ in first)
+    assert all(result["resumed"] for _, result, _ in second)
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import transcription_core as core
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_batch_job_does_not_hold_a_worker_and_can_be_cancelled(mock_server, client, page_files, tmp_path):
+    mock_server.batch_delay = 60
+    queue = core.JobQueue(max_concurrency=2, max_running_jobs=1)
+    pages = page_files(2)
+
+    def run_batch(job, executor):
+        return core.run_batch_transcription(job.pages, "p", [], client, poll_interval=0.05, cancel=job.cancel_event)
+
+    def run_parallel(job, executor):
+        return core.run_bulk_transcription(job.pages, "p", [], client, executor=executor, cancel=job.cancel_event)
+
+    batch_job = queue.submit("a", pages, run_batch, str(tmp_path / "batch.csv"), remote=True)
+    wait_until(lambda: mock_server.batches)
+    parallel_job = queue.submit("b", pages, run_parallel, str(tmp_path / "parallel.csv"))
+
+    # The only worker is free for the parallel job while the batch is processed
+    wait_until(lambda: parallel_job.finished)
+    assert parallel_job.status == "done"
+    assert batch_job.status == "running"
+
+    queue.cancel(batch_job.id)
+    wait_until(lambda: batch_job.finished)
+    assert batch_job.status == "cancelled"
+    assert all(batch["cancelled_at"] is not None for batch in mock_server.batches.values())
+
+
+def test_cancel_stops_batch_submission(mock_server, client, page_files):
+    cancel = threading.Event()
+    cancel.set()
+
+    results = list(core.run_batch_transcription(page_files(2), "p", [], client, cancel=cancel))
+
+    assert results == []
+    assert not mock_server.batches
+
+
+def test_cancelled_job_writes_the_pages_in_flight(mock_server, client, page_files, tmp_path):
+    mock_server.latency = 0.2
+    queue = core.JobQueue(max_concurrency=2, max_running_jobs=1)
+    results_path = str(tmp_path / "results.csv")
+
+    def run(job, executor):
+        return core.run_bulk_transcription(job.pages, "p", [], client, max_concurrency=2, executor=executor, cancel=job.cancel_event)
+
+    job = queue.submit("a", page_files(20), run, results_path)
+    wait_until(lambda: job.completed >= 3)
+    queue.cancel(job.id)
+    wait_until(lambda: job.finished)
+
+    assert job.status == "cancelled"
+    assert job.completed < 20
+    # Every page that was sent is in the result file, and no pages were sent after the cancel
+    assert len(core.read_result_rows(results_path)) == job.completed == mock_server.message_count
+
+
+def test_closed_run_records_the_pages_in_flight(mock_server, client, page_files, tmp_path):
+    mock_server.latency = 0.2
+    journal = core.JobJournal(str(tmp_path / "journal.sqlite"))
+    pages = page_files(20)
+
+    bulk_run = core.run_bulk_transcription(pages, "p", [], client, max_concurrency=2, journal=journal, prefetch=10)
+    next(bulk_run)
+    bulk_run.close()
+
+    # The prefetched pages that had not started were dropped, and the ones that were sent
+    # are resumed from the journal
+    sent = mock_server.message_count
+    assert sent <= 4
+    resumed = [result for _, result, _ in core.run_bulk_transcription(pages[:sent], "p", [], client, journal=journal)]
+    assert all(result["resumed"] for result in resumed)
+
+
+def test_finished_jobs_expire_with_their_result_files(client, page_files, tmp_path):
+    queue = core.JobQueue(max_concurrency=2, max_running_jobs=1, finished_job_ttl=0.5)
+    pages = page_files(1)
+
+    def run(job, executor):
+        return core.run_bulk_transcription(job.pages, "p", [], client, executor=executor, cancel=job.cancel_event)
+
+    expired = queue.submit("a", pages, run, str(tmp_path / "expired.csv"))
+    wait_until(lambda: expired.finished)
+    time.sleep(0.6)
+    recent = queue.submit("a", pages, run, str(tmp_path / "recent.csv"))
+    wait_until(lambda: recent.finished)
+
+    queue.forget_expired()
+
+    assert queue.owner_jobs("a") == [recent]
+    assert not (tmp_path / "expired.csv").exists()
+    assert (tmp_path / "recent.csv").exists()
+
+
+def test_forgotten_job_deletes_its_result_file(client, page_files, tmp_path):
+    queue = core.JobQueue(max_concurrency=2, max_running_jobs=1)
+
+    def run(job, executor):
+        return core.run_bulk_transcription(job.pages, "p", [], client, executor=executor, cancel=job.cancel_event)
+
+    job = queue.submit("a", page_files(1), run, str(tmp_path / "results.csv"))
+    wait_until(lambda: job.finished)
+    queue.forget(job.id)
+
+    assert queue.owner_jobs("a") == []
+    assert not (tmp_path / "results.csv").exists()
@@ -0,0 +1,26 @@
+import transcription_core as core
+
+FAST_RETRIES = {**core.DEFAULT_RETRY_POLICY, "base_delay": 0.01, "max_delay": 0.05, "breaker_threshold": 0}
+
+
+def test_retries_count_each_repeated_attempt_once(mock_server, client, page_files, metrics):
+    mock_server.outage = 3
+
+    results = list(core.run_bulk_transcription(page_files(1), "p", [], client, max_concurrency=1, retry_policy=FAST_RETRIES))
+
+    assert results[0][2] is None
+    summary = metrics.summary()
+    assert summary["calls"] == 4
+    assert summary["errors"] == 3
+    assert summary["retries"] == 3
+    assert metrics.totals["retries"] == 3
+
+
+def test_successful_calls_record_usage(client, page_files, metrics):
+    list(core.run_bulk_transcription(page_files(2), "p", [], client, max_concurrency=2))
+
+    summary = metrics.summary()
+    assert summary["calls"] == 2
+    assert summary["retries"] == 0
+    assert summary["input_tokens"] > 0
+    assert summary["models"][core.MODEL]["calls"] == 2
@@ -0,0 +1,54 @@
+import hashlib
+import io
+import json
+import zipfile
+
+from PIL import Image
+
+import transcription_core as core
+
+
+# A version 2 archive as saved before image dimensions were stored: a flat message
+# history whose images are blob references without width and height
+def version_2_archive(size):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "white").save(buffer, format="PNG")
+    data = buffer.getvalue()
+    blob_hash = hashlib.sha256(data).hexdigest()
+    history = [
+        {"role": "user", "content": [
+            {"type": "image", "source": {"type": "profile_blob", "media_type": "image/png", "blob": blob_hash}},
+            {"type": "text", "text": "Transkribera."}
+        ]},
+        {"role": "assistant", "content": "Anno 1742"},
+        {"role": "user", "content": core.feedback_prompt("Anno 1743")},
+        {"role": "assistant", "content": "Jag läste årtalet fel."}
+    ]
+    manifest = {"format_version": 2, "conversation_history": history, "metadata": {"name": "v2"}}
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr(core.PROFILE_MANIFEST_NAME, json.dumps(manifest))
+        zf.writestr(f"images/{blob_hash}", data)
+    return archive.getvalue()
+
+
+def test_version_2_archive_without_dimensions_loads():
+    iterations, metadata, blob_store = core.parse_profile(version_2_archive((320, 480)))
+
+    assert metadata["name"] == "v2"
+    assert len(iterations) == 1
+    image = iterations[0]["image"]
+    assert (image["width"], image["height"]) == (320, 480)
+    assert iterations[0]["correction"] == "Anno 1743"
+    assert blob_store.read(image["blob"])
+
+
+def test_migrated_profile_round_trips():
+    iterations, metadata, blob_store = core.parse_profile(version_2_archive((320, 480)))
+
+    saved = core.serialize_profile(iterations, metadata, blob_store)
+    reloaded, _, _ = core.parse_profile(saved)
+
+    assert reloaded[0]["image"]["width"] == 320
+    assert reloaded[0]["transcription"] == "Anno 1742"
@@ -0,0 +1,61 @@
+import transcription_core as core
+
+FAST_RETRIES = {**core.DEFAULT_RETRY_POLICY, "base_delay": 0.01, "max_delay": 0.05, "breaker_threshold": 0}
+
+
+def errors(results):
+    return [error for _, _, error in results if error is not None]
+
+
+def test_circuit_breaker_pauses_during_outage_and_recovers(mock_server, client, page_files):
+    mock_server.outage = 4
+    policy = {**FAST_RETRIES, "breaker_threshold": 2, "breaker_cooldown": 0.2}
+    executor = core.RequestExecutor(1, policy)
+
+    results = list(core.run_bulk_transcription(page_files(3), "p", [], client, max_concurrency=1, executor=executor))
+
+    assert errors(results) == []
+    assert executor.breaker.times_opened >= 1
+    assert mock_server.faults["error"] == 4
+
+
+def test_pages_that_run_out_of_attempts_get_a_final_retry_pass(mock_server, client, page_files):
+    mock_server.outage = 2
+    policy = {**FAST_RETRIES, "max_attempts": 2}
+
+    results = list(core.run_bulk_transcription(page_files(2), "p", [], client, max_concurrency=1, retry_policy=policy))
+
+    assert errors(results) == []
+    assert len(results) == 2
+
+
+def test_without_retry_pass_exhausted_pages_fail(mock_server, client, page_files):
+    mock_server.outage = 2
+    policy = {**FAST_RETRIES, "max_attempts": 2, "retry_failed": False}
+
+    results = list(core.run_bulk_transcription(page_files(2), "p", [], client, max_concurrency=1, retry_policy=policy))
+
+    assert len(errors(results)) == 1
+    assert core.is_retryable_error(errors(results)[0])
+
+
+def test_stalled_calls_time_out_and_are_retried(mock_server, client, page_files):
+    mock_server.stall_rate = 0.5
+    mock_server.stall_seconds = 2.0
+    mock_server.random.seed(1)
+    policy = {**FAST_RETRIES, "timeout": 0.3}
+
+    results = list(core.run_bulk_transcription(page_files(4), "p", [], client, max_concurrency=2, retry_policy=policy))
+
+    assert errors(results) == []
+    assert mock_server.faults["stall"] > 0
+
+
+def test_client_errors_are_not_retried(mock_server, client, page_files):
+    mock_server.outage = 1
+    mock_server.error_status = 400
+
+    results = list(core.run_bulk_transcription(page_files(1), "p", [], client, max_concurrency=1, retry_policy=FAST_RETRIES))
+
+    assert len(errors(results)) == 1
+    assert mock_server.request_count == 1
@@ -0,0 +1,25 @@
+from PIL import Image
+
+import transcription_core as core
+
+TILING = {**core.DEFAULT_TILING, "enabled": True, "bands": 3, "min_height": 1000}
+
+
+def test_tiled_page_runs_through_request_executor(mock_server, client):
+    executor = core.RequestExecutor(2)
+    with Image.new("RGB", (300, 2400), "white") as image:
+        result = core.transcribe_tiled(image, "p", [], client, TILING, executor=executor)
+
+    assert result["tiles"] == 3
+    assert result["transcription"]
+    assert mock_server.message_count == 3
+
+
+def test_bulk_run_tiles_tall_pages(mock_server, client, page_files):
+    pages = page_files(2, size=(300, 2400))
+
+    results = list(core.run_bulk_transcription(pages, "p", [], client, max_concurrency=2, tiling=TILING))
+
+    assert [error for _, _, error in results] == [None, None]
+    assert all(result["tiles"] == 3 for _, result, _ in results)
+    assert mock_server.message_count == 6
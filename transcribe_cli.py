@@ -0,0 +1,278 @@
+# Command-line runner for transcribing manuscript images without Streamlit.
+#
+# Example:
+#     python transcribe_cli.py --profile manuscript_training.zip --output results.jsonl scans/
+#
+# Results are written to the output file (JSONL, or CSV if the file name ends
+# in .csv) as each page completes, so partial results survive an interrupted run.
+# Rows are in completion order; the position column gives the upload order.
+
+import argparse
+import glob
+import logging
+import os
+import sys
+
+import transcription_core as core
+
+# File extensions picked up when a directory is given as input
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png") + tuple(core.DOCUMENT_EXTENSIONS)
+
+# Expand files, directories and glob patterns into a list of image and document paths without duplicates
+def collect_image_paths(inputs):
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(
+                os.path.join(item, name)
+                for name in sorted(os.listdir(item))
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        elif os.path.isfile(item):
+            paths.append(item)
+        else:
+            paths.extend(sorted(glob.glob(item, recursive=True)))
+    return list(dict.fromkeys(paths))
+
+# Report the progress of submitted message batches
+def print_batch_status(batches):
+    for batch in batches:
+        counts = batch.request_counts
+        print(
+            f"Batch {batch.id}: {batch.processing_status} "
+            f"({counts.succeeded} klara, {counts.errored} fel, {counts.processing} kvar)",
+            file=sys.stderr
+        )
+
+# Report the API metrics of the run: totals, and latency percentiles of the recent calls
+def print_metrics_summary(metrics):
+    totals = metrics.total_counts()
+    if not totals["calls"]:
+        return
+    summary = metrics.summary()
+    latency = ""
+    if summary["latency_p50"] is not None:
+        latency = f", svarstid p50 {summary['latency_p50']:.1f} s / p95 {summary['latency_p95']:.1f} s"
+    print(
+        f"Anrop: {totals['calls']} ({totals['errors']} fel, {totals['retries']} omförsök){latency}, "
+        f"{totals['input_tokens'] + totals['cache_read_tokens'] + totals['cache_write_tokens']} indatatokens, "
+        f"{totals['output_tokens']} utdatatokens, uppskattad kostnad {totals['cost_usd']:.4f} USD",
+        file=sys.stderr
+    )
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Transkribera manuskriptbilder utan webbgränssnittet.")
+    parser.add_argument("inputs", nargs="+", help="Bildfiler, kataloger eller glob-mönster (t.ex. 'arkiv/**/*.jpg').")
+    parser.add_argument("-o", "--output", required=True, help="Resultatfil (.jsonl eller .csv).")
+    parser.add_argument("-p", "--profile", help="Sparad träningsprofil (.zip eller äldre .json).")
+    parser.add_argument("--prompt", default=core.DEFAULT_PROMPT, help="Prompt för Claude.")
+    parser.add_argument("--prompt-file", help="Läs prompten från en textfil.")
+    parser.add_argument("-m", "--model", default=core.MODEL, help=f"Modell för transkriptionen ({', '.join(core.MODELS)}).")
+    parser.add_argument("--cascade", action="store_true", help="Låt en snabb modell läsa varje sida först och skicka bara osäkra sidor till --model.")
+    parser.add_argument("--fast-model", default=core.FAST_MODEL, help="Snabb modell i kaskadläget.")
+    parser.add_argument("--max-uncertain", type=int, default=core.DEFAULT_ROUTING["max_uncertain"], help="Antal ord den snabba modellen får markera som osäkra innan sidan eskaleras.")
+    parser.add_argument("--double-check", action="store_true", help="Läs varje sida två gånger med den snabba modellen och eskalera om läsningarna skiljer sig.")
+    parser.add_argument("--min-agreement", type=float, default=core.DEFAULT_ROUTING["min_agreement"], help="Minsta likhet mellan de två snabba läsningarna (0–1).")
+    parser.add_argument("--batch", action="store_true", help="Skicka alla sidor som en Message Batch (billigare, klart inom 24 h).")
+    parser.add_argument("--poll-interval", type=float, default=core.BATCH_POLL_INTERVAL, help="Sekunder mellan statuskontroller i batchläge.")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Max antal samtidiga anrop.")
+    parser.add_argument("--timeout", type=float, default=core.DEFAULT_RETRY_POLICY["timeout"], help="Sekunder innan ett anrop avbryts.")
+    parser.add_argument("--max-attempts", type=int, default=core.DEFAULT_RETRY_POLICY["max_attempts"], help="Max antal försök per sida vid tillfälliga fel.")
+    parser.add_argument("--breaker-threshold", type=int, default=core.DEFAULT_RETRY_POLICY["breaker_threshold"], help="Antal misslyckade anrop i rad som pausar hela körningen (0 = aldrig).")
+    parser.add_argument("--breaker-cooldown", type=float, default=core.DEFAULT_RETRY_POLICY["breaker_cooldown"], help="Sekunder som körningen pausas när API:et inte svarar.")
+    parser.add_argument("--no-retry-failed", action="store_true", help="Försök inte igen med misslyckade sidor i slutet av körningen.")
+    parser.add_argument("--journal", default=core.DEFAULT_JOURNAL_PATH, help="Jobbjournal för att återuppta avbrutna körningar.")
+    parser.add_argument("--no-journal", action="store_true", help="Använd ingen jobbjournal.")
+    parser.add_argument("--result-cache", default=core.DEFAULT_RESULT_CACHE_PATH, help="Resultatcache som delas mellan jobb.")
+    parser.add_argument("--no-result-cache", action="store_true", help="Gå förbi resultatcachen och transkribera alla sidor på nytt.")
+    parser.add_argument("--no-prompt-cache", action="store_true", help="Cacha inte träningshistoriken.")
+    parser.add_argument("--max-tokens", type=int, default=core.DEFAULT_OUTPUT_LIMITS["max_tokens"], help="Max antal tokens per anrop.")
+    parser.add_argument("--max-continuations", type=int, default=core.DEFAULT_OUTPUT_LIMITS["max_continuations"], help="Max antal fortsättningar när en sida når tokengränsen.")
+    parser.add_argument("--history-mode", choices=list(core.HISTORY_POLICY_MODES), default=core.DEFAULT_HISTORY_POLICY["mode"])
+    parser.add_argument("--keep-iterations", type=int, default=core.DEFAULT_HISTORY_POLICY["keep_iterations"])
+    parser.add_argument("--token-budget", type=int, default=core.DEFAULT_HISTORY_POLICY["token_budget"])
+    parser.add_argument("--tile-bands", type=int, default=0, help="Dela höga sidor i så många överlappande band (0 = ingen uppdelning).")
+    parser.add_argument("--tile-overlap", type=float, default=core.DEFAULT_TILING["overlap"], help="Andel av bandhöjden som överlappar nästa band.")
+    parser.add_argument("--tile-min-height", type=int, default=core.DEFAULT_TILING["min_height"], help="Dela endast sidor som är högre än så här många pixlar.")
+    parser.add_argument("--dpi", type=int, default=core.DEFAULT_PDF_DPI, help="Upplösning när PDF-sidor rastreras.")
+    parser.add_argument("--max-long-edge", type=int, default=core.DEFAULT_PREPROCESSING["max_long_edge"])
+    parser.add_argument("--color-mode", choices=["original", "grayscale", "binarize"], default=core.DEFAULT_PREPROCESSING["color_mode"])
+    parser.add_argument("--binarize-threshold", type=int, default=core.DEFAULT_PREPROCESSING["binarize_threshold"])
+    parser.add_argument("--image-format", choices=list(core.MEDIA_TYPES), default=core.DEFAULT_PREPROCESSING["format"])
+    parser.add_argument("--quality", type=int, default=core.DEFAULT_PREPROCESSING["quality"])
+    parser.add_argument("--metrics-log", help="Skriv mätvärden för varje anrop som JSON-rader till denna fil.")
+    parser.add_argument("--metrics-port", type=int, help="Exponera mätvärden för Prometheus på denna port under körningen.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Visa detaljerad loggning.")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+
+    prompt = args.prompt
+    if args.prompt_file:
+        with open(args.prompt_file, encoding="utf-8") as f:
+            prompt = f.read().strip()
+
+    paths = collect_image_paths(args.inputs)
+    if not paths:
+        print("Inga bilder eller dokument hittades.", file=sys.stderr)
+        return 1
+
+    # The Anthropic SDK is imported while the profile is loaded and the pages are listed
+    client_warmup = core.ClientWarmup(timeout=args.timeout)
+
+    iterations, blob_store = [], None
+    if args.profile:
+        iterations, metadata, blob_store = core.load_profile_file(args.profile)
+        print(f"Träningsprofil: {metadata['name']} ({metadata['iterations']} iterationer)", file=sys.stderr)
+
+    preprocessing = {
+        "max_long_edge": args.max_long_edge,
+        "color_mode": args.color_mode,
+        "binarize_threshold": args.binarize_threshold,
+        "format": args.image_format,
+        "quality": args.quality
+    }
+    output_limits = {
+        "max_tokens": args.max_tokens,
+        "max_continuations": args.max_continuations
+    }
+    tiling = {
+        "enabled": args.tile_bands > 1,
+        "bands": args.tile_bands,
+        "overlap": args.tile_overlap,
+        "min_height": args.tile_min_height
+    }
+    if tiling["enabled"] and args.batch:
+        print("Uppdelning i band stöds inte i batchläge.", file=sys.stderr)
+        return 1
+    routing = {
+        "model": args.model,
+        "cascade": args.cascade,
+        "fast_model": args.fast_model,
+        "max_uncertain": args.max_uncertain,
+        "double_check": args.double_check,
+        "min_agreement": args.min_agreement
+    }
+    if routing["cascade"] and args.batch:
+        print("Kaskadläget stöds inte i batchläge.", file=sys.stderr)
+        return 1
+    retry_policy = {
+        "timeout": args.timeout,
+        "max_attempts": args.max_attempts,
+        "base_delay": core.DEFAULT_RETRY_POLICY["base_delay"],
+        "max_delay": core.DEFAULT_RETRY_POLICY["max_delay"],
+        "breaker_threshold": args.breaker_threshold,
+        "breaker_cooldown": args.breaker_cooldown,
+        "retry_failed": not args.no_retry_failed
+    }
+    history_policy = {
+        "mode": args.history_mode,
+        "keep_iterations": args.keep_iterations,
+        "token_budget": args.token_budget
+    }
+
+    metrics = core.get_metrics()
+    metrics.set_log_path(args.metrics_log)
+    if args.metrics_port:
+        core.start_metrics_server(args.metrics_port)
+
+    client = client_warmup.client()
+    # In the "similar" mode every page gets the training iterations most like it instead of a shared history
+    examples = None
+    history_key = None
+    if history_policy["mode"] == "similar":
+        examples = core.ExampleSelector(iterations, history_policy, prompt, blob_store)
+        history = []
+    else:
+        history = core.apply_history_policy(iterations, history_policy, prompt, client)
+        # The journal identifies the history by its training iterations, since a summary is written anew on each run
+        history_key = core.history_fingerprint(iterations, history_policy)
+
+    # Multi-page documents are split into pages here, but a page is only rasterized when it is sent
+    pages = [page for path in paths for page in core.document_pages(path, path, args.dpi)]
+    journal = None if args.no_journal else core.JobJournal(args.journal)
+    result_cache = None if args.no_result_cache else core.ResultCache(args.result_cache)
+    writer = core.ResultWriter(args.output)
+    failures = 0
+    resumed = 0
+    cached = 0
+    tiers = {}
+    try:
+        if args.batch:
+            bulk_run = core.run_batch_transcription(
+                pages,
+                prompt,
+                history,
+                client,
+                cache_history=not args.no_prompt_cache,
+                preprocessing=preprocessing,
+                blob_store=blob_store,
+                output_limits=output_limits,
+                journal=journal,
+                result_cache=result_cache,
+                poll_interval=args.poll_interval,
+                on_status=print_batch_status,
+                routing=routing,
+                examples=examples,
+                retry_policy=retry_policy,
+                history_key=history_key
+            )
+        else:
+            bulk_run = core.run_bulk_transcription(
+                pages,
+                prompt,
+                history,
+                client,
+                max_concurrency=args.concurrency,
+                cache_history=not args.no_prompt_cache,
+                preprocessing=preprocessing,
+                blob_store=blob_store,
+                output_limits=output_limits,
+                journal=journal,
+                result_cache=result_cache,
+                tiling=tiling,
+                retry_policy=retry_policy,
+                routing=routing,
+                examples=examples,
+                history_key=history_key
+            )
+        for completed, (i, result, error) in enumerate(bulk_run, start=1):
+            name, source = pages[i]
+            label = core.page_label(name, source)
+            writer.write(core.bulk_result_row(name, result, error, core.page_number(source), i + 1))
+            if error is None:
+                core.count_tier(tiers, result)
+                if result.get("escalation"):
+                    label += f" (eskalerad: {core.ESCALATION_LABELS[result['escalation']]})"
+            if error is not None:
+                failures += 1
+                print(f"[{completed}/{len(pages)}] FEL {label}: {error}", file=sys.stderr)
+            elif result.get("resumed"):
+                resumed += 1
+                print(f"[{completed}/{len(pages)}] {label} (från jobbjournalen)", file=sys.stderr)
+            elif result.get("cached"):
+                cached += 1
+                print(f"[{completed}/{len(pages)}] {label} (från resultatcachen)", file=sys.stderr)
+            else:
+                print(f"[{completed}/{len(pages)}] {label}", file=sys.stderr)
+    finally:
+        writer.close()
+        if journal is not None:
+            journal.close()
+        if result_cache is not None:
+            result_cache.close()
+
+    print(
+        f"Klart: {len(pages) - failures} av {len(pages)} sidor transkriberade till {args.output} "
+        f"({resumed} från jobbjournalen, {cached} från resultatcachen)",
+        file=sys.stderr
+    )
+    if routing["cascade"]:
+        print(f"Nivåer: {core.format_tier_counts(tiers)}", file=sys.stderr)
+    print_metrics_summary(metrics)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
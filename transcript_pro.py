@@ -1,12 +1,26 @@
+import time
+
+# Start of this run of the script, for the startup and rerun timings
+run_started = time.perf_counter()
+
 import streamlit as st
-import anthropic
 import os
-import json
-import time
+import logging
+import tempfile
+import uuid
+from collections import deque
 from PIL import Image
-import io
-import base64
 from datetime import datetime
+import transcription_core as core
+
+# Only the first run in a process really imports the modules above; later runs find them loaded
+import_seconds = time.perf_counter() - run_started
+
+# Log image encoding details to the console
+logger = logging.getLogger(core.__name__)
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
 
 # Set page configuration
 st.set_page_config(
@@ -15,35 +29,145 @@ st.set_page_config(
     layout="wide"
 )
 
-# Initialize Anthropic client
+# Number of bulk result rows shown in the results table
+BULK_PREVIEW_ROWS = 200
+
+# Seconds between progress updates of unfinished bulk jobs
+BULK_REFRESH_SECONDS = 2
+
+# Number of training iterations shown per page in the history viewer
+HISTORY_PAGE_SIZE = 10
+
+# File types accepted in direct mode: images and multi-page documents
+UPLOAD_TYPES = ["jpg", "jpeg", "png", "pdf", "tif", "tiff"]
+
+# Number of recent script runs in the rerun timings
+RERUN_WINDOW = 200
+
+# Server setting (environment variable or secret) with the path of the metrics log; an empty value turns the log off
+METRICS_LOG_SETTING = "TRANSCRIPTION_METRICS_LOG"
+
+# Start creating the Anthropic client once per process, on a background thread
 @st.cache_resource
-def get_client():
+def get_client_warmup():
     api_key = os.environ.get("ANTHROPIC_API_KEY")
     if not api_key:
-        api_key = st.secrets.get("ANTHROPIC_API_KEY", None)
-    if not api_key:
-        raise ValueError("Ingen Anthropic API-nyckel hittades. Ange ANTHROPIC_API_KEY som miljövariabel.")
-    return anthropic.Anthropic(api_key=api_key)
+        # Without a secrets file the warm-up fails, and the missing key is reported when the client is used
+        try:
+            api_key = st.secrets.get("ANTHROPIC_API_KEY", None)
+        except FileNotFoundError:
+            api_key = None
+    return core.ClientWarmup(api_key)
+
+# The Anthropic client, waiting for the warm-up if it is still running.
+# A failed warm-up is discarded, so the next call tries again.
+def get_client():
+    warmup = get_client_warmup()
+    try:
+        return warmup.client()
+    except Exception:
+        get_client_warmup.clear()
+        raise
 
-# Convert image to base64 for Anthropic API
-def image_to_base64(img):
-    buffered = io.BytesIO()
-    img.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+# Startup and rerun timings of this server process
+@st.cache_resource
+def get_app_timings():
+    return {"imports": None, "reruns": deque(maxlen=RERUN_WINDOW)}
+
+# Open the persistent result cache once per process
+@st.cache_resource
+def get_result_cache():
+    return core.ResultCache()
+
+# Start the metrics log once per process, at the path of the server setting or the default path.
+# The log covers the calls of every session, so it is not a setting of the individual session.
+@st.cache_resource
+def get_metrics_log_path():
+    path = os.environ.get(METRICS_LOG_SETTING)
+    if path is None:
+        try:
+            path = st.secrets.get(METRICS_LOG_SETTING, None)
+        except FileNotFoundError:
+            path = None
+    if path is None:
+        path = core.DEFAULT_METRICS_LOG_PATH
+    core.get_metrics().set_log_path(path or None)
+    return path or None
+
+# Start the Prometheus metrics endpoint once per process and port
+@st.cache_resource
+def get_metrics_server(port):
+    return core.start_metrics_server(port)
+
+# The bulk job queue shared by all sessions of this server process
+@st.cache_resource
+def get_job_queue():
+    return core.JobQueue()
+
+# Parse a training profile once per process, so sessions that load the same file share it read-only
+@st.cache_resource(max_entries=16)
+def get_shared_profile(profile_data):
+    return core.parse_profile(profile_data)
+
+# The first run in the process records how long the imports took
+app_timings = get_app_timings()
+if app_timings["imports"] is None:
+    app_timings["imports"] = import_seconds
+    logger.info("Kallstart: importerna tog %.2f s", import_seconds)
+
+# Import the Anthropic SDK in the background while the first page is drawn
+get_client_warmup()
+get_metrics_log_path()
 
 # Initialize session state variables
-if "conversation_history" not in st.session_state:
-    st.session_state.conversation_history = []
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if "training_iterations" not in st.session_state:
+    st.session_state.training_iterations = []
 if "current_workflow_stage" not in st.session_state:
     st.session_state.current_workflow_stage = "upload"
 if "current_iteration" not in st.session_state:
     st.session_state.current_iteration = 0
 if "default_prompt" not in st.session_state:
-    st.session_state.default_prompt = "Vänligen transkribera den handskrivna texten i denna manuskriptbild så noggrant som möjligt. Läs rad för rad, och ord för ord. När du är klar, läs hela transkriptionen och giv akt på sammanhanget och språklig logik Inkludera endast den transkriberade texten i ditt svar utan någon ytterligare kommentar."
+    st.session_state.default_prompt = core.DEFAULT_PROMPT
 if "app_mode" not in st.session_state:
     st.session_state.app_mode = "training"  # "training" or "direct"
+if "preprocessing" not in st.session_state:
+    st.session_state.preprocessing = dict(core.DEFAULT_PREPROCESSING)
+if "output_limits" not in st.session_state:
+    st.session_state.output_limits = dict(core.DEFAULT_OUTPUT_LIMITS)
+if "prompt_caching" not in st.session_state:
+    st.session_state.prompt_caching = True
+if "use_job_journal" not in st.session_state:
+    st.session_state.use_job_journal = True
+if "use_result_cache" not in st.session_state:
+    st.session_state.use_result_cache = True
+if "pdf_dpi" not in st.session_state:
+    st.session_state.pdf_dpi = core.DEFAULT_PDF_DPI
+if "tiling" not in st.session_state:
+    st.session_state.tiling = dict(core.DEFAULT_TILING)
+if "metrics_endpoint" not in st.session_state:
+    st.session_state.metrics_endpoint = False
+if "metrics_port" not in st.session_state:
+    st.session_state.metrics_port = 9464
+if "bulk_backend" not in st.session_state:
+    st.session_state.bulk_backend = "parallel"  # "parallel" or "batch"
+if "bulk_max_concurrency" not in st.session_state:
+    st.session_state.bulk_max_concurrency = 4
+if "routing" not in st.session_state:
+    st.session_state.routing = dict(core.DEFAULT_ROUTING)
+if "retry_policy" not in st.session_state:
+    st.session_state.retry_policy = dict(core.DEFAULT_RETRY_POLICY)
 if "direct_mode_type" not in st.session_state:
     st.session_state.direct_mode_type = "Enstaka sida"  # "Enstaka sida" or "Bulk-transkription (flera sidor)"
+if "history_policy" not in st.session_state:
+    st.session_state.history_policy = dict(core.DEFAULT_HISTORY_POLICY)
+if "history_index" not in st.session_state:
+    st.session_state.history_index = {"iterations": None, "scanned": 0, "completed": []}
+if "history_summaries" not in st.session_state:
+    st.session_state.history_summaries = {}
+if "profile_blobs" not in st.session_state:
+    st.session_state.profile_blobs = None
 if "training_metadata" not in st.session_state:
     st.session_state.training_metadata = {
         "name": "Onamngiven träningssession",
@@ -52,77 +176,299 @@ if "training_metadata" not in st.session_state:
         "iterations": 0
     }
 
-# Function to save training history to JSON
+# Function to save training history as a compact profile archive
 def save_training_history():
-    data = {
-        "conversation_history": st.session_state.conversation_history,
-        "metadata": st.session_state.training_metadata
-    }
-    return json.dumps(data, ensure_ascii=False)
+    return core.serialize_profile(
+        st.session_state.training_iterations,
+        st.session_state.training_metadata,
+        st.session_state.profile_blobs
+    )
 
-# Function to load training history from JSON
-def load_training_history(json_string):
+# Function to load training history from a profile archive or a legacy JSON file
+def load_training_history(profile_data):
     try:
-        data = json.loads(json_string)
-        st.session_state.conversation_history = data["conversation_history"]
-        st.session_state.training_metadata = data["metadata"]
+        iterations, metadata, blob_store = get_shared_profile(profile_data)
+        # The loaded iterations are shared with other sessions; training mode only appends to this copy of the list
+        st.session_state.training_iterations = list(iterations)
+        st.session_state.training_metadata = dict(metadata)
+        st.session_state.profile_blobs = blob_store
         return True
     except Exception as e:
         st.error(f"Fel vid inläsning av träningshistorik: {str(e)}")
         return False
 
+# Trim the session's training history according to its history policy
+def session_history(prompt, client):
+    return core.apply_history_policy(
+        st.session_state.training_iterations,
+        st.session_state.history_policy,
+        prompt,
+        client,
+        st.session_state.history_summaries
+    )
+
+# Identifies the session's training history in page keys, so they do not change with a regenerated summary
+def session_history_key():
+    return core.history_fingerprint(st.session_state.training_iterations, st.session_state.history_policy)
+
+# The per-page example selector when the history policy picks the most similar iterations, else None
+def session_examples(prompt):
+    if st.session_state.history_policy["mode"] != "similar":
+        return None
+    return core.ExampleSelector(
+        st.session_state.training_iterations,
+        st.session_state.history_policy,
+        prompt,
+        st.session_state.profile_blobs
+    )
+
+# Format token counts for display
+def format_usage(usage):
+    return (
+        f"Tokens – indata: {usage['input_tokens']}, "
+        f"cacheträffar: {usage['cache_read_tokens']}, "
+        f"cachemissar (skrivna): {usage['cache_write_tokens']}, "
+        f"utdata: {usage['output_tokens']}"
+    )
+
+# Show streamed text in a placeholder as it arrives
+def stream_to(placeholder):
+    parts = []
+    def on_text(text):
+        parts.append(text)
+        placeholder.text("".join(parts) + "▌")
+    return on_text
+
+# The result cache, or None when the user has chosen to bypass it
+def session_result_cache():
+    return get_result_cache() if st.session_state.use_result_cache else None
+
+# Interactive calls share the job queue's concurrency limit, but are not retried since their text is streamed to the page
+def interactive_executor():
+    return get_job_queue().request_executor({**st.session_state.retry_policy, "max_attempts": 1})
+
+# Interactive calls use the selected model without the cascade, since their text is streamed as it arrives
+def interactive_routing():
+    return {**st.session_state.routing, "cascade": False}
+
 # Function to handle the transcription process
-def process_transcription(image, prompt, update_history=True):
+# Returns a dict with the transcription and the token usage of the call
+# If source_digest is given, the result cache is checked first and the result is marked "cached" on a hit
+# Outside training mode, tall pages are split into bands if tiling is enabled; bands are not streamed
+def process_transcription(image, prompt, update_history=True, cache_history=False, on_text=None, source_digest=None):
     client = get_client()
-    base64_image = image_to_base64(image)
+    examples = session_examples(prompt)
+    history = examples.history(image) if examples is not None else session_history(prompt, client)
+    tiling = None if update_history else st.session_state.tiling
     
-    # Construct the complete message history for context
-    messages = []
+    result_cache = session_result_cache() if source_digest is not None else None
+    if result_cache is not None:
+        history_key = session_history_key() if examples is None else None
+        key = core.page_key(source_digest, core.job_fingerprint(prompt, history, st.session_state.preprocessing, tiling, interactive_routing(), output_limits=st.session_state.output_limits, history_key=history_key))
+        cached = result_cache.get(key)
+        if cached is not None:
+            return {**cached, "cached": True}
     
-    # Add all previous conversation history
-    for msg in st.session_state.conversation_history:
-        messages.append(msg)
+    if core.should_tile(image, tiling):
+        # Bands are retried by the executor, so the SDK's own retries are turned off
+        retry_policy = st.session_state.retry_policy
+        result = core.transcribe_tiled(
+            image,
+            prompt,
+            history,
+            client.with_options(max_retries=0, timeout=retry_policy["timeout"]),
+            tiling,
+            cache_history=cache_history,
+            preprocessing=st.session_state.preprocessing,
+            blob_store=st.session_state.profile_blobs,
+            output_limits=st.session_state.output_limits,
+            executor=get_job_queue().request_executor(retry_policy),
+            routing=interactive_routing()
+        )
+    else:
+        result = interactive_executor().run(lambda attempt: core.process_transcription(
+            image,
+            prompt,
+            history,
+            client,
+            cache_history=cache_history,
+            preprocessing=st.session_state.preprocessing,
+            blob_store=st.session_state.profile_blobs,
+            on_text=on_text,
+            output_limits=st.session_state.output_limits,
+            attempt=attempt,
+            model=st.session_state.routing["model"]
+        ))
     
-    # Create the user message with the current image and prompt
-    user_message = {
-        "role": "user",
-        "content": [
-            {
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": "image/png",
-                    "data": base64_image
-                }
-            },
-            {
-                "type": "text",
-                "text": prompt
-            }
-        ]
-    }
+    if result_cache is not None and not result["truncated"]:
+        result_cache.put(key, core.journal_result(result))
+    
+    # If we should update the history (training mode), start a new training iteration
+    if update_history:
+        st.session_state.training_iterations.append(
+            core.new_iteration(result["user_message"], prompt, result["transcription"])
+        )
+    
+    return result
+
+# Function to get Claude's reflection on the user's correction of the latest transcription
+# Records the correction and the reflection in the current training iteration
+def process_feedback(correction, on_text=None):
+    client = get_client()
+    history = session_history(core.feedback_prompt(correction), client)
+    result = interactive_executor().run(lambda attempt: core.process_feedback(
+        correction,
+        history,
+        client,
+        blob_store=st.session_state.profile_blobs,
+        on_text=on_text,
+        output_limits=st.session_state.output_limits,
+        model=st.session_state.routing["model"]
+    ))
     
-    # Add to the messages for the API call
-    messages.append(user_message)
+    iteration = st.session_state.training_iterations[-1]
+    iteration["correction"] = correction
+    iteration["reflection"] = result["transcription"]
+    return result
+
+# Index of the completed training iterations as (position, image key) pairs, for the history viewer.
+# Iterations are only ever added at the end, and only the newest one changes afterwards, when its
+# feedback arrives, so each rerun only looks at the iterations added since the last one.
+def history_index():
+    iterations = st.session_state.training_iterations
+    index = st.session_state.history_index
+    if index["iterations"] is not iterations or index["scanned"] > len(iterations):
+        index = {"iterations": iterations, "scanned": 0, "completed": []}
+        st.session_state.history_index = index
     
-    # Call Claude API
-    response = client.messages.create(
-        model="claude-3-5-sonnet-20241022",
-        max_tokens=1000,
-        messages=messages
+    start = max(0, index["scanned"] - 1)
+    if index["completed"] and index["completed"][-1][0] >= start:
+        index["completed"].pop()
+    index["completed"].extend(
+        (position, core.iteration_image_key(iterations[position]["image"]))
+        for position in range(start, len(iterations))
+        if iterations[position]["correction"] is not None
     )
+    index["scanned"] = len(iterations)
+    return index["completed"]
+
+# Preview of a training iteration's image, made once per image and shared between sessions
+@st.cache_data(max_entries=1000)
+def iteration_thumbnail(image_key, _image, _blob_store):
+    return core.iteration_thumbnail(_image, _blob_store)
+
+# Show rolling aggregates of the recent API calls
+def show_metrics_summary():
+    summary = core.get_metrics().summary()
+    st.header("API-mätvärden")
+    if not summary["calls"]:
+        st.caption("Inga anrop än.")
+        return
     
-    transcription = response.content[0].text
+    st.write(f"**Anrop:** {summary['calls']} ({summary['errors']} fel, {summary['retries']} omförsök)")
+    if summary["latency_p50"] is not None:
+        st.write(f"**Svarstid:** p50 {summary['latency_p50']:.1f} s, p95 {summary['latency_p95']:.1f} s")
+    st.write(
+        f"**Per anrop:** {summary['encode_seconds_mean'] * 1000:.0f} ms kodning, "
+        f"{summary['payload_bytes_mean'] / 1024:.0f} kB data"
+    )
+    st.write(
+        f"**Tokens:** {summary['input_tokens']} indata, {summary['output_tokens']} utdata, "
+        f"{summary['cache_read_tokens']} cacheträffar, {summary['cache_write_tokens']} cacheskrivningar"
+    )
+    st.write(f"**Uppskattad kostnad:** {summary['cost_usd']:.4f} USD")
+    if len(summary["models"]) > 1:
+        for model, model_summary in summary["models"].items():
+            latency = f", p50 {model_summary['latency_p50']:.1f} s" if model_summary["latency_p50"] is not None else ""
+            st.write(f"**{core.MODELS.get(model, model)}:** {model_summary['calls']} anrop{latency}, {model_summary['cost_usd']:.4f} USD")
+    st.caption(f"Rullande fönster över högst {core.METRICS_WINDOW} anrop i denna process.")
+
+# Show how long the cold start's imports and the client warm-up took, and the time of each script run
+def show_timing_report(rerun_seconds):
+    reruns = sorted(app_timings["reruns"])
+    warmup = get_client_warmup()
+    with st.expander("Start- och körtider"):
+        st.write(f"**Importer vid kallstart:** {app_timings['imports']:.2f} s")
+        if not warmup.ready:
+            st.write("**Anthropic-klienten:** skapas i bakgrunden...")
+        elif warmup.error is not None:
+            st.write("**Anthropic-klienten:** kunde inte skapas")
+        else:
+            st.write(f"**Anthropic-klienten:** skapad på {warmup.seconds:.2f} s")
+        st.write(f"**Denna körning:** {rerun_seconds * 1000:.0f} ms")
+        st.write(
+            f"**Körningar:** p50 {core.percentile(reruns, 50) * 1000:.0f} ms, "
+            f"p95 {core.percentile(reruns, 95) * 1000:.0f} ms"
+        )
+        st.caption(f"De senaste {len(reruns)} körningarna av skriptet i denna process. Körningar som avbryts i förtid räknas inte.")
+
+# Show how many pages of a cascade job were accepted from the fast model and how many were escalated
+def show_tier_counts(job):
+    if job.tiers.get("fast") or job.tiers.get("escalated"):
+        st.text(f"Nivåer: {core.format_tier_counts(job.tiers)}")
+
+# Show the progress of a bulk job, and its results once it has finished
+def show_bulk_job(job):
+    queue = get_job_queue()
+    st.subheader(f"Jobb {job.id} ({job.total} sidor)")
     
-    # If we should update the history (training mode), add the exchange to conversation history
-    if update_history:
-        st.session_state.conversation_history.append(user_message)
-        st.session_state.conversation_history.append({
-            "role": "assistant",
-            "content": transcription
-        })
+    if job.status == "queued":
+        st.info(f"Väntar i kön ({queue.queued_count()} jobb väntar totalt på servern).")
+    elif job.status == "running":
+        st.progress(job.completed / job.total if job.total else 1.0)
+        status = (
+            f"{job.completed} av {job.total} sidor klara, varav {job.resumed} från jobbjournalen "
+            f"och {job.cached} från resultatcachen"
+        )
+        if job.last_label:
+            status += f" (senast: {job.last_label})"
+        st.text(status)
+        if job.detail:
+            st.text(job.detail)
+        show_tier_counts(job)
+    elif job.status == "failed":
+        st.error(f"Jobbet avbröts av ett fel efter {job.completed} av {job.total} sidor: {job.error}")
+    elif job.status == "cancelled":
+        st.warning(f"Jobbet avbröts efter {job.completed} av {job.total} sidor.")
+    else:
+        st.success(f"Transkribering klar! {job.total} sidor bearbetade, varav {job.failures} med fel.")
+        show_tier_counts(job)
+    
+    if not job.finished:
+        if st.button("Avbryt jobbet", key=f"cancel_job_{job.id}"):
+            queue.cancel(job.id)
+            st.rerun()
+        return
     
-    return transcription
+    # The queue deletes the result file once the job has expired
+    if job.completed and os.path.exists(job.results_path):
+        # Only the first rows in upload order are kept for display; the full results stay in the file
+        import pandas as pd
+        preview_rows = core.read_result_rows(job.results_path, BULK_PREVIEW_ROWS)
+        results_df = pd.DataFrame(preview_rows, columns=core.BULK_RESULT_FIELDS)
+        
+        # Display the results in a table
+        st.dataframe(results_df)
+        st.caption(
+            f"Visar de första {len(results_df)} raderna i uppladdningsordning. Hela resultatet finns i CSV-filen, "
+            "där raderna står i den ordning sidorna blev klara och kolumnen position anger uppladdningsordningen."
+        )
+        
+        # Create a download button
+        with open(job.results_path, "rb") as results_file:
+            st.download_button(
+                label="Ladda ner resultat som CSV",
+                data=results_file,
+                file_name=f"transkriptionsresultat_{job.id}.csv",
+                mime="text/csv",
+                key=f"download_job_{job.id}"
+            )
+    
+    # Option to clear results, which the queue otherwise does once the job has expired
+    st.caption(f"Jobbet och dess resultat tas bort från servern {queue.finished_job_ttl / 3600:.0f} timmar efter att det avslutades.")
+    if st.button("Rensa resultat", key=f"forget_job_{job.id}"):
+        queue.forget(job.id)
+        st.rerun()
 
 # Main app title
 st.title("Transkriptionsassistent för Manuskript")
@@ -142,7 +488,201 @@ st.session_state.app_mode = "training" if app_mode == "Träningsläge" else "dir
 # Sidebar for app controls and settings
 with st.sidebar:
     st.header("Inställningar")
-    st.write("Modell: claude-3-5-sonnet-20241022")
+    st.session_state.routing["model"] = st.selectbox(
+        "Modell:",
+        list(core.MODELS),
+        index=list(core.MODELS).index(st.session_state.routing["model"]),
+        format_func=lambda model: core.MODELS[model]
+    )
+    
+    # Image preprocessing applied before the images are sent to Claude
+    with st.expander("Bildförbehandling"):
+        preprocessing = st.session_state.preprocessing
+        
+        preprocessing["max_long_edge"] = st.number_input(
+            "Max längd på bildens längsta sida (pixlar):",
+            min_value=200,
+            max_value=8000,
+            value=preprocessing["max_long_edge"],
+            help=f"Claude har ingen nytta av mer än cirka {core.MAX_USEFUL_LONG_EDGE} pixlar på den längsta sidan."
+        )
+        
+        color_modes = {"original": "Original", "grayscale": "Gråskala", "binarize": "Svartvit (binarisering)"}
+        preprocessing["color_mode"] = st.selectbox(
+            "Färgläge:",
+            list(color_modes),
+            index=list(color_modes).index(preprocessing["color_mode"]),
+            format_func=lambda mode: color_modes[mode]
+        )
+        
+        if preprocessing["color_mode"] == "binarize":
+            preprocessing["binarize_threshold"] = st.slider(
+                "Tröskelvärde för binarisering:",
+                min_value=0,
+                max_value=255,
+                value=preprocessing["binarize_threshold"]
+            )
+        
+        st.session_state.pdf_dpi = st.number_input(
+            "Upplösning för PDF-sidor (DPI):",
+            min_value=72,
+            max_value=600,
+            step=25,
+            value=st.session_state.pdf_dpi,
+            help="PDF-sidor rastreras med denna upplösning först när de ska skickas till Claude."
+        )
+        
+        preprocessing["format"] = st.selectbox(
+            "Bildformat:",
+            list(core.MEDIA_TYPES),
+            index=list(core.MEDIA_TYPES).index(preprocessing["format"])
+        )
+        
+        if preprocessing["format"] != "PNG":
+            preprocessing["quality"] = st.slider(
+                "Kvalitet:",
+                min_value=10,
+                max_value=100,
+                value=preprocessing["quality"]
+            )
+        
+        # Show how well the encoding cache is working
+        cache_stats = core.get_encoding_cache().stats()
+        st.caption(
+            f"Bildkodningscache: {cache_stats['hits']} träffar, {cache_stats['misses']} missar, "
+            f"{cache_stats['entries']} bilder ({cache_stats['bytes'] / (1024 * 1024):.1f} MB)"
+        )
+    
+    # Output length per page
+    with st.expander("Utdata"):
+        output_limits = st.session_state.output_limits
+        
+        output_limits["max_tokens"] = st.number_input(
+            "Max antal tokens per anrop:",
+            min_value=100,
+            max_value=8192,
+            step=100,
+            value=output_limits["max_tokens"]
+        )
+        
+        output_limits["max_continuations"] = st.number_input(
+            "Max antal fortsättningar per sida:",
+            min_value=0,
+            max_value=20,
+            value=output_limits["max_continuations"],
+            help="Om en transkription avbryts vid tokengränsen fortsätter Claude där texten slutade."
+        )
+        
+        st.caption(f"Utdatabudget per sida: {output_limits['max_tokens'] * (output_limits['max_continuations'] + 1)} tokens")
+    
+    # How much of the training history is sent as context with each call
+    with st.expander("Kontexthantering"):
+        history_policy = st.session_state.history_policy
+        
+        history_policy["mode"] = st.selectbox(
+            "Träningshistorik i kontexten:",
+            list(core.HISTORY_POLICY_MODES),
+            index=list(core.HISTORY_POLICY_MODES).index(history_policy["mode"]),
+            format_func=lambda mode: core.HISTORY_POLICY_MODES[mode]
+        )
+        
+        if history_policy["mode"] != "all":
+            history_policy["keep_iterations"] = st.number_input(
+                "Antal liknande iterationer som skickas per sida:" if history_policy["mode"] == "similar" else "Antal senaste iterationer som skickas i sin helhet:",
+                min_value=1,
+                max_value=100,
+                value=history_policy["keep_iterations"]
+            )
+        
+        history_policy["token_budget"] = st.number_input(
+            "Tokenbudget för kontexten:",
+            min_value=5000,
+            max_value=200000,
+            step=5000,
+            value=history_policy["token_budget"],
+            help="De äldsta, eller minst liknande, iterationerna tas bort tills anropet ryms inom budgeten."
+        )
+        
+        if st.session_state.training_iterations:
+            estimated_tokens = sum(
+                core.estimate_iteration_tokens(iteration)
+                for iteration in st.session_state.training_iterations
+            )
+            st.caption(f"Uppskattad storlek på hela träningshistoriken: {estimated_tokens} tokens")
+
+    # Where the per-call metrics are exported
+    with st.expander("Mätvärden"):
+        metrics_log_path = get_metrics_log_path()
+        if metrics_log_path:
+            st.caption(f"Mätvärdesloggen (ett JSON-objekt per anrop) skrivs till {metrics_log_path}.")
+        else:
+            st.caption("Mätvärdesloggen är avstängd.")
+        st.caption(f"Loggen gäller hela servern och ställs in med {METRICS_LOG_SETTING}.")
+        st.session_state.metrics_endpoint = st.checkbox(
+            "Exponera mätvärden för Prometheus",
+            value=st.session_state.metrics_endpoint
+        )
+        if st.session_state.metrics_endpoint:
+            st.session_state.metrics_port = st.number_input(
+                "Port:",
+                min_value=1024,
+                max_value=65535,
+                value=st.session_state.metrics_port
+            )
+            try:
+                get_metrics_server(st.session_state.metrics_port)
+                st.caption(f"Mätvärden finns på http://127.0.0.1:{st.session_state.metrics_port}/metrics")
+            except OSError as e:
+                st.error(f"Kunde inte starta mätvärdesservern: {str(e)}")
+    
+    # Settings used only in direct mode: splitting of tall pages into bands, and the result cache
+    if st.session_state.app_mode == "direct":
+        with st.expander("Uppdelning av stora sidor"):
+            tiling = st.session_state.tiling
+            
+            tiling["enabled"] = st.checkbox(
+                "Dela upp höga sidor i horisontella band",
+                value=tiling["enabled"],
+                help="Banden transkriberas samtidigt och fogas sedan ihop, så att stora folioblad behåller mer av sin upplösning."
+            )
+            
+            if tiling["enabled"]:
+                tiling["min_height"] = st.number_input(
+                    "Dela endast sidor som är högre än (pixlar):",
+                    min_value=500,
+                    max_value=20000,
+                    step=100,
+                    value=tiling["min_height"]
+                )
+                tiling["bands"] = st.slider("Antal band:", min_value=2, max_value=8, value=tiling["bands"])
+                tiling["overlap"] = st.slider(
+                    "Överlappning mellan banden:",
+                    min_value=0.05,
+                    max_value=0.4,
+                    step=0.05,
+                    value=tiling["overlap"],
+                    help="Andel av bandets höjd som delas med nästa band. Text i överlappningen tas bara med en gång."
+                )
+                st.caption("Uppdelning används inte med Message Batches.")
+        
+        # Results of pages transcribed before, reused instead of calling Claude again
+        with st.expander("Resultatcache"):
+            st.session_state.use_result_cache = st.checkbox(
+                "Återanvänd tidigare transkriptioner av identiska sidor",
+                value=st.session_state.use_result_cache,
+                help="Avmarkera för att gå förbi cachen och skicka alla sidor till Claude igen."
+            )
+
+            cache_stats = get_result_cache().stats()
+            st.caption(
+                f"{cache_stats['entries']} sparade resultat ({cache_stats['bytes'] / 1024:.0f} kB av "
+                f"{core.RESULT_CACHE_MAX_BYTES // (1024 * 1024)} MB), "
+                f"{cache_stats['hits']} träffar och {cache_stats['misses']} missar sedan start"
+            )
+
+            if st.button("Töm resultatcachen"):
+                get_result_cache().clear()
+                st.rerun()
     
     # Training history management
     st.divider()
@@ -150,12 +690,11 @@ with st.sidebar:
     # In direct mode, allow loading training history
     if st.session_state.app_mode == "direct":
         st.header("Ladda träningshistorik")
-        uploaded_history = st.file_uploader("Välj en sparad träningsfil (.json)", type=["json"])
+        uploaded_history = st.file_uploader("Välj en sparad träningsfil (.zip eller äldre .json)", type=["zip", "json"])
         
         if uploaded_history is not None:
             if st.button("Ladda träningshistorik"):
-                content = uploaded_history.read().decode("utf-8")
-                success = load_training_history(content)
+                success = load_training_history(uploaded_history.read())
                 if success:
                     st.success(f"Träningshistorik laddad: {st.session_state.training_metadata['name']} ({st.session_state.training_metadata['iterations']} iterationer)")
                     # Reset workflow stage but keep conversation history
@@ -167,7 +706,7 @@ with st.sidebar:
                     st.rerun()
     
     # In training mode, allow saving training history
-    elif st.session_state.app_mode == "training" and len(st.session_state.conversation_history) > 0:
+    elif st.session_state.app_mode == "training" and len(st.session_state.training_iterations) > 0:
         st.header("Spara träningshistorik")
         
         # Edit metadata for the training session
@@ -187,15 +726,15 @@ with st.sidebar:
         st.session_state.training_metadata["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
         if st.button("Spara träningshistorik"):
-            json_data = save_training_history()
+            profile_data = save_training_history()
             now = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"manuscript_training_{now}.json"
+            filename = f"manuscript_training_{now}.zip"
             
             st.download_button(
                 label="Ladda ner träningsfil",
-                data=json_data,
+                data=profile_data,
                 file_name=filename,
-                mime="application/json"
+                mime="application/zip"
             )
     
     st.divider()
@@ -204,19 +743,28 @@ with st.sidebar:
     if st.session_state.app_mode == "training":
         st.header("Träningsstatistik")
         st.write(f"**Aktuell iteration:** {st.session_state.current_iteration + 1}")
-        st.write(f"**Antal meddelanden i historik:** {len(st.session_state.conversation_history)}")
+        st.write(f"**Antal iterationer i historik:** {len(st.session_state.training_iterations)}")
     else:
         st.header("Direktlägesstatus")
-        if len(st.session_state.conversation_history) > 0:
+        if len(st.session_state.training_iterations) > 0:
             st.write(f"**Aktiv träningsprofil:** {st.session_state.training_metadata['name']}")
             st.write(f"**Träningsiterationer:** {st.session_state.training_metadata['iterations']}")
             st.info("I direktläge bevaras den ursprungliga träningshistoriken och nya transkriptioner läggas inte till i kontexten.")
+            st.session_state.prompt_caching = st.checkbox(
+                "Cacha träningshistoriken (prompt-cachning)",
+                value=st.session_state.prompt_caching,
+                help="Markerar den laddade träningshistoriken som ett cachebart prefix så att efterföljande anrop återanvänder den."
+            )
         else:
             st.warning("Ingen träningshistorik laddad. Ladda en träningsprofil för bästa resultat.")
     
+    # Filled in at the end of the script, so calls made during this run are included
+    metrics_panel = st.empty()
+    
     # Reset button
     if st.button("Återställ applikationen"):
-        st.session_state.conversation_history = []
+        st.session_state.training_iterations = []
+        st.session_state.profile_blobs = None
         st.session_state.current_workflow_stage = "upload"
         st.session_state.current_iteration = 0
         st.session_state.training_metadata = {
@@ -281,13 +829,15 @@ if st.session_state.app_mode == "training":
                         st.session_state.default_prompt = custom_prompt
                         
                         # Get transcription from Claude
-                        transcription = process_transcription(st.session_state.current_image, custom_prompt)
+                        transcription = process_transcription(
+                            st.session_state.current_image,
+                            custom_prompt,
+                            on_text=stream_to(st.empty())
+                        )["transcription"]
                         
-                        # Save the transcription and update the conversation history
+                        # Save the transcription; process_transcription has started a new training iteration
                         st.session_state.current_transcription = transcription
                         
-                        # process_transcription now handles adding to conversation history
-                        
                         # Move to the next stage
                         st.session_state.current_workflow_stage = "transcribe"
                         st.rerun()
@@ -312,32 +862,11 @@ if st.session_state.app_mode == "training":
             if st.button("Skicka feedback"):
                 with st.spinner("Claude reflekterar över feedbacken..."):
                     try:
-                        # Create the feedback prompt
-                        feedback_prompt = f"""Här är den korrekta transkriptionen av manuskriptet:
-
-{correct_transcription}
-
-Jämför din transkription med den korrekta versionen ovan. 
-1. Vilka specifika fel gjorde du?
-2. Vilka aspekter av handskriften var svåra att tyda?
-3. Vad kan du lära dig för att förbättra framtida transkriptioner?
-
-Var specifik i din analys för att kunna förbättra din förmåga att transkribera liknande manuskript i framtiden."""
-                        
-                        # Get Claude's reflection
-                        reflection = process_transcription(st.session_state.current_image, feedback_prompt)
-                        
-                        # Store the feedback exchange in conversation history
-                        # Note: We always update history for feedback in training mode
-                        st.session_state.conversation_history.append({
-                            "role": "user",
-                            "content": feedback_prompt
-                        })
-                        
-                        st.session_state.conversation_history.append({
-                            "role": "assistant",
-                            "content": reflection
-                        })
+                        # Get Claude's reflection; it is recorded in the current training iteration
+                        reflection = process_feedback(
+                            correct_transcription,
+                            on_text=stream_to(st.empty())
+                        )["transcription"]
                         
                         # Increment the iteration counter
                         st.session_state.current_iteration += 1
@@ -396,15 +925,31 @@ else:
         # Single page transcription mode
         with col1:
             st.subheader("Ladda upp ett manuskript")
-            uploaded_file = st.file_uploader("Välj en bild av ett handskrivet manuskript", type=["jpg", "jpeg", "png"])
+            uploaded_file = st.file_uploader(
+                "Välj en bild eller ett flersidigt dokument (PDF/TIFF) av ett handskrivet manuskript",
+                type=UPLOAD_TYPES
+            )
             
             if uploaded_file is not None:
+                # Split documents into pages; only the selected page is rasterized
+                try:
+                    pages = core.document_pages(uploaded_file.name, uploaded_file, st.session_state.pdf_dpi)
+                except Exception as e:
+                    st.error(f"Kunde inte läsa dokumentet: {str(e)}")
+                    st.stop()
+                
+                page_index = 0
+                if len(pages) > 1:
+                    page_index = st.number_input(f"Sida (av {len(pages)}):", min_value=1, max_value=len(pages), value=1) - 1
+                name, source = pages[page_index]
+                
                 # Process the uploaded image
-                image = Image.open(uploaded_file)
-                st.image(image, caption="Manuskript för direkt transkription", use_column_width=True)
+                image = core.open_page(source)
+                st.image(image, caption=core.page_label(name, source), use_column_width=True)
                 
-                # Store the image for processing
+                # Store the image for processing, with the hash used to look it up in the result cache
                 st.session_state.direct_mode_image = image
+                st.session_state.direct_mode_digest = core.source_digest(source)
         
         with col2:
             # Show prompt editor and transcribe button if an image is uploaded
@@ -424,14 +969,24 @@ else:
                         try:
                             # Get transcription from Claude using all previous training
                             # Pass update_history=False to prevent adding to conversation history in direct mode
-                            transcription = process_transcription(
+                            # The text is streamed into a placeholder until the result below takes over
+                            stream_placeholder = st.empty()
+                            result = process_transcription(
                                 st.session_state.direct_mode_image, 
                                 direct_prompt,
-                                update_history=False
+                                update_history=False,
+                                cache_history=st.session_state.prompt_caching,
+                                on_text=stream_to(stream_placeholder),
+                                source_digest=st.session_state.direct_mode_digest
                             )
+                            stream_placeholder.empty()
                             
                             # Display the result
-                            st.session_state.direct_transcription = transcription
+                            st.session_state.direct_transcription = result["transcription"]
+                            st.session_state.direct_usage = result["usage"]
+                            st.session_state.direct_continuations = (result["continuations"], result["truncated"])
+                            st.session_state.direct_cached = result.get("cached", False)
+                            st.session_state.direct_tiles = result.get("tiles", 0)
                             
                         except Exception as e:
                             st.error(f"Ett fel uppstod vid transkriberingen: {str(e)}")
@@ -445,6 +1000,24 @@ else:
                         height=300
                     )
                     
+                    # Show token usage so prompt-cache hits can be verified
+                    if st.session_state.get("direct_cached"):
+                        st.caption("Hämtad från resultatcachen – inget nytt API-anrop gjordes.")
+                    elif "direct_usage" in st.session_state:
+                        st.caption(format_usage(st.session_state.direct_usage))
+                    
+                    # Report continuation calls made because the page hit the token limit
+                    if "direct_continuations" in st.session_state:
+                        continuations, truncated = st.session_state.direct_continuations
+                        if continuations:
+                            st.caption(f"Transkriptionen fortsattes {continuations} gång(er) efter att ha nått tokengränsen.")
+                        if truncated:
+                            st.warning("Transkriptionen är fortfarande avkortad. Höj tokengränsen eller antalet fortsättningar.")
+                    
+                    # Report when the page was transcribed in bands and stitched together
+                    if st.session_state.get("direct_tiles"):
+                        st.caption(f"Sidan delades upp i {st.session_state.direct_tiles} band som transkriberades samtidigt och fogades ihop.")
+                    
                     # Option to copy to clipboard
                     if st.button("Kopiera till urklipp"):
                         st.code(st.session_state.direct_transcription)
@@ -454,6 +1027,14 @@ else:
                     if st.button("Rensa och transkribera en ny bild"):
                         if "direct_transcription" in st.session_state:
                             del st.session_state.direct_transcription
+                        if "direct_usage" in st.session_state:
+                            del st.session_state.direct_usage
+                        if "direct_continuations" in st.session_state:
+                            del st.session_state.direct_continuations
+                        if "direct_cached" in st.session_state:
+                            del st.session_state.direct_cached
+                        if "direct_tiles" in st.session_state:
+                            del st.session_state.direct_tiles
                         if "direct_mode_image" in st.session_state:
                             del st.session_state.direct_mode_image
                         st.rerun()
@@ -463,23 +1044,109 @@ else:
     else:  # Bulk transcription mode
         st.subheader("Bulk-transkription av flera manuskript")
         
-        # Initialize session state for bulk transcription if not already done
-        if "bulk_transcription_results" not in st.session_state:
-            st.session_state.bulk_transcription_results = []
-        
-        if "bulk_transcription_completed" not in st.session_state:
-            st.session_state.bulk_transcription_completed = False
-        
-        if "bulk_transcription_progress" not in st.session_state:
-            st.session_state.bulk_transcription_progress = 0
-        
         # Allow uploading multiple files
         uploaded_files = st.file_uploader(
-            "Välj flera bilder av handskrivna manuskript", 
-            type=["jpg", "jpeg", "png"],
+            "Välj flera bilder eller flersidiga dokument (PDF/TIFF) av handskrivna manuskript", 
+            type=UPLOAD_TYPES,
             accept_multiple_files=True
         )
         
+        # Send pages one by one in parallel, or all at once as an offline message batch
+        bulk_backends = {
+            "parallel": "Parallella anrop (resultat direkt)",
+            "batch": "Message Batches (lägre kostnad, klart inom 24 timmar)"
+        }
+        st.session_state.bulk_backend = st.radio(
+            "Körsätt:",
+            list(bulk_backends),
+            index=list(bulk_backends).index(st.session_state.bulk_backend),
+            format_func=lambda backend: bulk_backends[backend]
+        )
+        
+        # Limit how many pages are sent to Claude at the same time
+        if st.session_state.bulk_backend == "parallel":
+            st.session_state.bulk_max_concurrency = st.number_input(
+                "Max antal samtidiga anrop:",
+                min_value=1,
+                max_value=32,
+                value=st.session_state.bulk_max_concurrency,
+                help=(
+                    "Sänks automatiskt tillfälligt om API:et signalerar överbelastning (429/529). "
+                    f"Högst {core.JOB_QUEUE_MAX_CONCURRENCY} anrop körs samtidigt för alla användare av servern tillsammans."
+                )
+            )
+            
+            # Let a fast model read every page first and escalate only the uncertain ones
+            with st.expander("Kaskad med snabb modell"):
+                routing = st.session_state.routing
+                
+                routing["cascade"] = st.checkbox(
+                    "Läs sidorna med en snabb modell först",
+                    value=routing["cascade"],
+                    help="Sidor som den snabba modellen är osäker på skickas vidare till den valda modellen."
+                )
+                
+                if routing["cascade"]:
+                    routing["fast_model"] = st.selectbox(
+                        "Snabb modell:",
+                        list(core.MODELS),
+                        index=list(core.MODELS).index(routing["fast_model"]),
+                        format_func=lambda model: core.MODELS[model]
+                    )
+                    routing["max_uncertain"] = st.number_input(
+                        "Eskalera när fler ord än så här är markerade som osäkra:",
+                        min_value=0,
+                        max_value=100,
+                        value=routing["max_uncertain"]
+                    )
+                    routing["double_check"] = st.checkbox(
+                        "Läs varje sida två gånger och eskalera om läsningarna skiljer sig",
+                        value=routing["double_check"]
+                    )
+                    if routing["double_check"]:
+                        routing["min_agreement"] = st.slider(
+                            "Minsta likhet mellan läsningarna:",
+                            min_value=0.5,
+                            max_value=1.0,
+                            step=0.01,
+                            value=routing["min_agreement"]
+                        )
+                    st.caption("Avkortade sidor eskaleras alltid. Kaskaden används bara vid parallella anrop.")
+            
+            # Timeouts, retries and the circuit breaker for transient API errors
+            with st.expander("Omförsök och tidsgränser"):
+                retry_policy = st.session_state.retry_policy
+                
+                retry_policy["timeout"] = st.number_input(
+                    "Tidsgräns per anrop (sekunder):",
+                    min_value=10.0,
+                    max_value=600.0,
+                    step=10.0,
+                    value=float(retry_policy["timeout"])
+                )
+                retry_policy["max_attempts"] = st.number_input(
+                    "Max antal försök per sida:",
+                    min_value=1,
+                    max_value=20,
+                    value=retry_policy["max_attempts"],
+                    help="Gäller tidsgränser, anslutningsfel, överbelastning och serverfel."
+                )
+                retry_policy["retry_failed"] = st.checkbox(
+                    "Försök igen med misslyckade sidor i slutet av körningen",
+                    value=retry_policy["retry_failed"]
+                )
+                st.caption(
+                    f"Om API:et inte svarar på {core.DEFAULT_RETRY_POLICY['breaker_threshold']} anrop i rad pausas "
+                    f"alla jobb på servern i {core.DEFAULT_RETRY_POLICY['breaker_cooldown']:.0f} sekunder."
+                )
+        
+        # Record finished pages so an interrupted batch can be resumed
+        st.session_state.use_job_journal = st.checkbox(
+            "Återuppta avbrutna jobb (hoppa över redan transkriberade sidor)",
+            value=st.session_state.use_job_journal,
+            help=f"Varje färdig sida sparas i en jobbjournal ({core.DEFAULT_JOURNAL_PATH})."
+        )
+        
         # Show the prompt input field
         bulk_prompt = st.text_area(
             "Prompt för Claude (används för alla bilder):", 
@@ -487,124 +1154,170 @@ else:
             height=150
         )
         
-        # Button to start bulk transcription
+        # Button to queue a bulk transcription job
         if uploaded_files and st.button("Starta bulk-transkription"):
-            # Reset results
-            st.session_state.bulk_transcription_results = []
-            st.session_state.bulk_transcription_completed = False
-            st.session_state.bulk_transcription_progress = 0
+            # Trim the training history once, so every page shares the same context, unless
+            # every page gets the iterations most similar to it
+            try:
+                examples = session_examples(bulk_prompt)
+                history = [] if examples is not None else session_history(bulk_prompt, get_client())
+            except Exception as e:
+                st.error(f"Ett fel uppstod vid förberedelse av träningshistoriken: {str(e)}")
+                st.stop()
             
-            # Create a progress bar
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            # Process each file
-            for i, uploaded_file in enumerate(uploaded_files):
-                # Update progress
-                progress_percent = int(100 * i / len(uploaded_files))
-                progress_bar.progress(progress_percent)
-                status_text.text(f"Transkriberar fil {i+1} av {len(uploaded_files)}: {uploaded_file.name}")
-                
-                try:
-                    # Process the image
-                    image = Image.open(uploaded_file)
-                    
-                    # Get transcription from Claude
-                    transcription = process_transcription(
-                        image, 
-                        bulk_prompt,
-                        update_history=False
-                    )
-                    
-                    # Store the result
-                    st.session_state.bulk_transcription_results.append({
-                        "filename": uploaded_file.name,
-                        "transcription": transcription
-                    })
-                    
-                except Exception as e:
-                    # Store the error
-                    st.session_state.bulk_transcription_results.append({
-                        "filename": uploaded_file.name,
-                        "transcription": f"FEL: {str(e)}"
-                    })
-            
-            # Complete the progress bar
-            progress_bar.progress(100)
-            status_text.text(f"Transkribering klar! {len(uploaded_files)} filer bearbetade.")
-            
-            # Mark as completed
-            st.session_state.bulk_transcription_completed = True
-            st.rerun()
-        
-        # If bulk transcription has been completed, show results and download option
-        if st.session_state.bulk_transcription_completed and st.session_state.bulk_transcription_results:
-            st.subheader("Bulk-transkriptionsresultat")
+            # Split documents into pages; each page is only rasterized when it is about to be sent
+            try:
+                pages = [
+                    page
+                    for uploaded_file in uploaded_files
+                    for page in core.document_pages(uploaded_file.name, uploaded_file, st.session_state.pdf_dpi)
+                ]
+            except Exception as e:
+                st.error(f"Kunde inte läsa dokumenten: {str(e)}")
+                st.stop()
             
-            # Create a DataFrame from the results
-            import pandas as pd
-            results_df = pd.DataFrame(st.session_state.bulk_transcription_results)
+            results_file, results_path = tempfile.mkstemp(prefix="transkriptionsresultat_", suffix=".csv")
+            os.close(results_file)
             
-            # Display the results in a table
-            st.dataframe(results_df)
+            # The job runs on the queue's worker threads, which cannot read the session state,
+            # so it gets its own copies of the settings
+            client = get_client()
+            bulk_backend = st.session_state.bulk_backend
+            use_job_journal = st.session_state.use_job_journal
+            max_concurrency = st.session_state.bulk_max_concurrency
+            tiling = dict(st.session_state.tiling)
+            routing = dict(st.session_state.routing)
+            if bulk_backend == "batch":
+                routing["cascade"] = False
+            options = {
+                "cache_history": st.session_state.prompt_caching,
+                "preprocessing": dict(st.session_state.preprocessing),
+                "blob_store": st.session_state.profile_blobs,
+                "output_limits": dict(st.session_state.output_limits),
+                "result_cache": session_result_cache(),
+                "examples": examples,
+                "history_key": session_history_key() if examples is None else None
+            }
             
-            # Create CSV for download
-            csv = results_df.to_csv(index=False)
+            def run_bulk_job(job, executor):
+                journal = core.JobJournal() if use_job_journal else None
+                try:
+                    if bulk_backend == "batch":
+                        # Submit all pages as message batches and show their status while waiting
+                        def show_batch_status(batches):
+                            succeeded = sum(batch.request_counts.succeeded for batch in batches)
+                            processing = sum(batch.request_counts.processing for batch in batches)
+                            job.detail = f"Batch behandlas hos Anthropic: {succeeded} sidor klara, {processing} kvar..."
+                        
+                        yield from core.run_batch_transcription(
+                            pages,
+                            bulk_prompt,
+                            history,
+                            client,
+                            journal=journal,
+                            on_status=show_batch_status,
+                            routing=routing,
+                            cancel=job.cancel_event,
+                            executor=executor,
+                            **options
+                        )
+                    else:
+                        # Process the pages concurrently, within the queue's limit for all users
+                        yield from core.run_bulk_transcription(
+                            pages,
+                            bulk_prompt,
+                            history,
+                            client,
+                            max_concurrency=max_concurrency,
+                            journal=journal,
+                            tiling=tiling,
+                            executor=executor,
+                            routing=routing,
+                            cancel=job.cancel_event,
+                            **options
+                        )
+                finally:
+                    if journal is not None:
+                        journal.close()
             
-            # Create a download button
-            st.download_button(
-                label="Ladda ner resultat som CSV",
-                data=csv,
-                file_name="transkriptionsresultat.csv",
-                mime="text/csv"
+            get_job_queue().submit(
+                st.session_state.session_id,
+                pages,
+                run_bulk_job,
+                results_path,
+                dict(st.session_state.retry_policy),
+                # Batch jobs wait for Anthropic on their own thread instead of a queue worker
+                remote=bulk_backend == "batch"
             )
+            st.rerun()
+        
+        # The session's jobs, newest first, refreshed every few seconds while any of them is unfinished
+        bulk_jobs = get_job_queue().owner_jobs(st.session_state.session_id)
+        jobs_active = any(not job.finished for job in bulk_jobs)
+        
+        @st.fragment(run_every=BULK_REFRESH_SECONDS if jobs_active else None)
+        def show_bulk_jobs():
+            jobs = get_job_queue().owner_jobs(st.session_state.session_id)
+            for job in reversed(jobs):
+                show_bulk_job(job)
             
-            # Option to clear results
-            if st.button("Rensa resultat och transkribera nya filer"):
-                st.session_state.bulk_transcription_results = []
-                st.session_state.bulk_transcription_completed = False
+            # Rerun the whole page once every job is done, which also stops the refreshing
+            if jobs_active and all(job.finished for job in jobs):
                 st.rerun()
+        
+        if bulk_jobs:
+            st.header("Bulk-jobb")
+            show_bulk_jobs()
 
-# Show training history
+# Show training history one page at a time, with thumbnails instead of the full images
 with st.expander("Visa träningshistorik"):
-    if len(st.session_state.conversation_history) > 0:
-        iteration = 1
-        message_index = 0
-        
-        while message_index < len(st.session_state.conversation_history):
-            # Try to find a complete iteration (4 messages)
-            if message_index + 3 < len(st.session_state.conversation_history):
-                # Get the messages
-                image_msg = st.session_state.conversation_history[message_index]
-                transcription_msg = st.session_state.conversation_history[message_index + 1]
+    iterations = st.session_state.training_iterations
+    completed = history_index()
+    if completed:
+        page_count = (len(completed) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        page = 1
+        if page_count > 1:
+            st.session_state.history_page = min(st.session_state.get("history_page", 1), page_count)
+            page = st.number_input("Sida:", min_value=1, max_value=page_count, key="history_page")
+        
+        shown = completed[(page - 1) * HISTORY_PAGE_SIZE:page * HISTORY_PAGE_SIZE]
+        st.caption(
+            f"Visar iteration {shown[0][0] + 1}–{shown[-1][0] + 1} av {len(completed)} fullständiga "
+            f"({len(iterations) - len(completed)} ofullständiga visas inte)."
+        )
+        
+        for position, image_key in shown:
+            iteration = iterations[position]
+            st.write(f"### Träningsiteration {position + 1}")
+            
+            image_column, text_column = st.columns([1, 3])
+            with image_column:
+                image = iteration["image"]
+                st.image(
+                    iteration_thumbnail(image_key, image, st.session_state.profile_blobs),
+                    caption=f"{image['width']}×{image['height']} px"
+                )
+            
+            with text_column:
+                # Display transcription
+                st.write("**Claudes transkription:**")
+                st.write(iteration["transcription"])
                 
-                # Check if this is a training iteration with feedback
-                if message_index + 3 < len(st.session_state.conversation_history) and "Här är den korrekta transkriptionen" in st.session_state.conversation_history[message_index + 2]["content"]:
-                    # This is a training iteration with feedback
-                    feedback_msg = st.session_state.conversation_history[message_index + 2]
-                    reflection_msg = st.session_state.conversation_history[message_index + 3]
-                    
-                    st.write(f"### Träningsiteration {iteration}")
-                    
-                    # Display transcription
-                    st.write("**Claudes transkription:**")
-                    st.write(transcription_msg["content"])
-                    
-                    # Display reflection
-                    st.write("**Claudes reflektion:**")
-                    st.write(reflection_msg["content"])
-                    
-                    st.divider()
-                    
-                    # Move to next iteration
-                    iteration += 1
-                    message_index += 4
-                else:
-                    # Skip to next message - we shouldn't have direct mode messages in history anymore
-                    message_index += 1
-            else:
-                # Handle remaining messages
-                st.write("*Ofullständig träningsiteration*")
-                break
+                # Display reflection
+                st.write("**Claudes reflektion:**")
+                st.write(iteration["reflection"])
+            
+            st.divider()
+    elif iterations:
+        st.write("Inga fullständiga träningsiterationer än.")
     else:
         st.write("Ingen träningshistorik än.")
+
+# Time this run up to here, so the report includes everything but drawing itself
+rerun_seconds = time.perf_counter() - run_started
+app_timings["reruns"].append(rerun_seconds)
+
+# Show the API metrics and timings in the sidebar now that this run's calls are done
+with metrics_panel.container():
+    show_metrics_summary()
+    show_timing_report(rerun_seconds)
@@ -0,0 +1,2445 @@
+# Transcription core shared by the Streamlit app and the command-line runner.
+# Nothing in this module depends on Streamlit, so batch jobs can use it
+# without paying for the Streamlit import.
+# The Anthropic SDK takes over a second to import, so it is only imported where a client
+# is created or its errors are inspected.
+
+import os
+import json
+import time
+import logging
+from PIL import Image
+import io
+import base64
+import csv
+import difflib
+import hashlib
+import heapq
+import random
+import sqlite3
+import threading
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Model used unless another one is selected
+MODEL = "claude-3-5-sonnet-20241022"
+
+# Models that can be selected, with a description for the user
+MODELS = {
+    "claude-3-5-sonnet-20241022": "Claude 3.5 Sonnet (noggrannast)",
+    "claude-3-haiku-20240307": "Claude 3 Haiku (snabbast och billigast)"
+}
+
+# Model that reads every page first in cascade mode
+FAST_MODEL = "claude-3-haiku-20240307"
+
+# Prompt used for transcription unless the user provides their own
+DEFAULT_PROMPT = "Vänligen transkribera den handskrivna texten i denna manuskriptbild så noggrant som möjligt. Läs rad för rad, och ord för ord. När du är klar, läs hela transkriptionen och giv akt på sammanhanget och språklig logik Inkludera endast den transkriberade texten i ditt svar utan någon ytterligare kommentar."
+
+# Seconds before an API call is abandoned as timed out
+REQUEST_TIMEOUT = 180.0
+
+# Create an Anthropic client, reading the API key from the environment if none is given
+def create_client(api_key=None, timeout=REQUEST_TIMEOUT):
+    if not api_key:
+        api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ValueError("Ingen Anthropic API-nyckel hittades. Ange ANTHROPIC_API_KEY som miljövariabel.")
+    import anthropic
+    return anthropic.Anthropic(api_key=api_key, timeout=timeout)
+
+# Creates the Anthropic client on a background thread, so importing the SDK overlaps with the
+# rest of startup instead of delaying the first request
+class ClientWarmup:
+    def __init__(self, api_key=None, timeout=REQUEST_TIMEOUT):
+        self.seconds = None
+        self._client = None
+        self.error = None
+        self._done = threading.Event()
+        threading.Thread(target=self._create, args=(api_key, timeout), name="client-warmup", daemon=True).start()
+    
+    def _create(self, api_key, timeout):
+        started = time.perf_counter()
+        try:
+            self._client = create_client(api_key, timeout)
+            logger.info("Anthropic-klienten skapades på %.2f s", time.perf_counter() - started)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.seconds = time.perf_counter() - started
+            self._done.set()
+    
+    @property
+    def ready(self):
+        return self._done.is_set()
+    
+    # The client, once it has been created; raises the error if creating it failed
+    def client(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self._client
+
+# Longest image edge the model makes use of; larger images are downscaled by the API anyway
+MAX_USEFUL_LONG_EDGE = 1568
+
+# Media types for the supported image encodings
+MEDIA_TYPES = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp"
+}
+
+# Default image preprocessing settings
+DEFAULT_PREPROCESSING = {
+    "max_long_edge": MAX_USEFUL_LONG_EDGE,
+    "color_mode": "original",  # "original", "grayscale" or "binarize"
+    "binarize_threshold": 160,
+    "format": "JPEG",
+    "quality": 90
+}
+
+# How the training history is trimmed before it is sent as context
+HISTORY_POLICY_MODES = {
+    "all": "Hela historiken",
+    "last_n": "Endast de senaste iterationerna",
+    "text_only": "Äldre iterationer endast som textkorrigeringar",
+    "summary": "Äldre iterationer som sammanfattade lärdomar",
+    "similar": "De iterationer som mest liknar sidan"
+}
+
+DEFAULT_HISTORY_POLICY = {
+    "mode": "all",
+    "keep_iterations": 5,
+    "token_budget": 150000
+}
+
+# Downscale and convert an image according to the preprocessing settings
+def preprocess_image(img, settings):
+    max_long_edge = settings["max_long_edge"]
+    if max(img.size) > max_long_edge:
+        scale = max_long_edge / max(img.size)
+        new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(new_size, Image.LANCZOS)
+    
+    if settings["color_mode"] == "grayscale":
+        img = img.convert("L")
+    elif settings["color_mode"] == "binarize":
+        threshold = settings["binarize_threshold"]
+        img = img.convert("L").point(lambda value: 255 if value >= threshold else 0)
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    
+    return img
+
+# Upper bound for the total size of the encoded images kept in memory
+ENCODING_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Thread-safe LRU cache of encoded images, bounded by the total size of the stored data
+class EncodedImageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        size = len(value[0])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key)[0])
+            self.entries[key] = value
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted[0])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes
+            }
+
+# The encoding cache is shared by everything running in this process
+_encoding_cache = EncodedImageCache(ENCODING_CACHE_MAX_BYTES)
+
+def get_encoding_cache():
+    return _encoding_cache
+
+# Build the cache key for an image from its pixel data and the preprocessing settings
+def encoding_cache_key(img, settings):
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(f"{img.mode}:{img.width}x{img.height}:".encode("utf-8"))
+    digest.update(img.tobytes())
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+# Convert image to base64 for Anthropic API
+# Returns the base64 data together with the media type matching the chosen encoding.
+# Results are memoized by image content, so repeated encodes of the same page are free.
+# A cache of its own can be given for images that will not be seen again once they are done,
+# so they do not fill the process-wide cache.
+def image_to_base64(img, settings=None, cache=None):
+    if settings is None:
+        settings = DEFAULT_PREPROCESSING
+    
+    if cache is None:
+        cache = get_encoding_cache()
+    cache_key = encoding_cache_key(img, settings)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    processed = preprocess_image(img, settings)
+    image_format = settings["format"]
+    save_options = {} if image_format == "PNG" else {"quality": settings["quality"]}
+    
+    buffered = io.BytesIO()
+    processed.save(buffered, format=image_format, **save_options)
+    encoded = buffered.getvalue()
+    
+    logger.info(
+        "Kodade bild %dx%d (%d byte okomprimerat) som %s %dx%d: %d byte",
+        img.width, img.height, img.width * img.height * len(img.getbands()),
+        image_format, processed.width, processed.height, len(encoded)
+    )
+    
+    result = (base64.b64encode(encoded).decode("utf-8"), MEDIA_TYPES[image_format])
+    cache.put(cache_key, result)
+    return result
+
+# Resolution used to rasterize PDF pages unless another one is chosen
+DEFAULT_PDF_DPI = 200
+
+# File extensions of multi-page documents, by document type
+DOCUMENT_EXTENSIONS = {
+    ".pdf": "pdf",
+    ".tif": "tiff",
+    ".tiff": "tiff"
+}
+
+# pdfium is not thread-safe, so PDF documents are only opened and rendered under this lock
+_pdfium_lock = threading.Lock()
+
+# A multi-page PDF or TIFF document. Only the page count is read up front;
+# pages are rasterized one at a time when they are opened.
+# The source is a path or a file-like object such as an uploaded file.
+class MultiPageDocument:
+    def __init__(self, source, kind, dpi=DEFAULT_PDF_DPI):
+        self.source = source
+        self.kind = kind
+        self.dpi = dpi
+        self.content_digest = None
+        self.lock = threading.Lock()
+        if kind == "pdf":
+            with _pdfium_lock:
+                document = self.open_pdf()
+                self.page_count = len(document)
+                document.close()
+        else:
+            with Image.open(self.read_source()) as image:
+                self.page_count = getattr(image, "n_frames", 1)
+
+    # Each reader gets its own handle, so pages can be opened from several threads
+    def read_source(self):
+        if isinstance(self.source, (str, os.PathLike)):
+            return self.source
+        return io.BytesIO(self.source.getvalue())
+
+    def open_pdf(self):
+        try:
+            import pypdfium2
+        except ImportError:
+            raise RuntimeError("PDF-filer kräver paketet pypdfium2 (pip install pypdfium2).")
+        if isinstance(self.source, (str, os.PathLike)):
+            return pypdfium2.PdfDocument(self.source)
+        return pypdfium2.PdfDocument(self.source.getvalue())
+
+    # Hash of the whole document, computed once and shared by its pages
+    def digest(self):
+        with self.lock:
+            if self.content_digest is None:
+                self.content_digest = source_digest(self.source)
+            return self.content_digest
+
+    # Rasterize a page (counted from 0) into a PIL image
+    def render(self, page_index):
+        if self.kind == "pdf":
+            with _pdfium_lock:
+                document = self.open_pdf()
+                try:
+                    page = document[page_index]
+                    image = page.render(scale=self.dpi / 72).to_pil()
+                    page.close()
+                finally:
+                    document.close()
+            return image
+        
+        with Image.open(self.read_source()) as image:
+            image.seek(page_index)
+            return image.copy()
+
+# One page of a multi-page document, used as a page source in place of an image file
+class DocumentPage:
+    def __init__(self, document, page_index):
+        self.document = document
+        self.page_index = page_index
+
+    @property
+    def page_number(self):
+        return self.page_index + 1
+
+    def digest(self):
+        return f"{self.document.digest()}:{self.page_index}:{self.document.kind}:{self.document.dpi}"
+
+# Open a page source: an image file, or a page of a multi-page document which is rasterized now
+def open_page(source):
+    if isinstance(source, DocumentPage):
+        return source.document.render(source.page_index)
+    return Image.open(source)
+
+# Expand a file into its pages as (name, source) pairs.
+# Multi-page documents give one DocumentPage per page; other files are a single page.
+def document_pages(name, source, dpi=DEFAULT_PDF_DPI):
+    kind = DOCUMENT_EXTENSIONS.get(os.path.splitext(name)[1].lower())
+    if kind is None:
+        return [(name, source)]
+    document = MultiPageDocument(source, kind, dpi)
+    return [(name, DocumentPage(document, page_index)) for page_index in range(document.page_count)]
+
+# Page number of a page source, or None for a single image
+def page_number(source):
+    return source.page_number if isinstance(source, DocumentPage) else None
+
+# Display label of a page: the file name, followed by the page number for document pages
+def page_label(name, source):
+    number = page_number(source)
+    return name if number is None else f"{name}, sida {number}"
+
+# Training history is kept as a list of iterations, one per manuscript page:
+#     {"image": {...}, "prompt": str, "transcription": str, "correction": str or None, "reflection": str or None}
+# The image is {"media_type", "width", "height"} plus either "data" (base64) or "blob" (a profile blob hash).
+# Correction and reflection stay None until the user has given feedback on the transcription.
+# Iterations are only rendered into API messages when a request is built.
+
+# Feedback prompt sent with the user's correction of a transcription
+FEEDBACK_PROMPT_TEMPLATE = """Här är den korrekta transkriptionen av manuskriptet:
+
+{correction}
+
+Jämför din transkription med den korrekta versionen ovan. 
+1. Vilka specifika fel gjorde du?
+2. Vilka aspekter av handskriften var svåra att tyda?
+3. Vad kan du lära dig för att förbättra framtida transkriptioner?
+
+Var specifik i din analys för att kunna förbättra din förmåga att transkribera liknande manuskript i framtiden."""
+
+# Feedback messages start with this text, which tells them apart from transcription requests
+FEEDBACK_PROMPT_PREFIX = "Här är den korrekta transkriptionen"
+
+# The API scales images down to about 1.15 megapixels, which costs at most about 1600 tokens
+MAX_IMAGE_TOKENS = 1600
+
+# Number of base64 characters decoded to read an image's dimensions from its header
+IMAGE_HEADER_BASE64_CHARS = 88000
+
+# Build the feedback prompt for a correction
+def feedback_prompt(correction):
+    return FEEDBACK_PROMPT_TEMPLATE.format(correction=correction)
+
+# Get the dimensions of an image block without decoding the whole image.
+# Blob references saved before the dimensions were stored are measured from the blob.
+def image_block_size(block, blob_store=None):
+    source = block["source"]
+    if source.get("width") is not None:
+        return source["width"], source["height"]
+    if source["type"] == "profile_blob":
+        return Image.open(io.BytesIO(blob_store.read(source["blob"]))).size
+    header = base64.b64decode(source["data"][:IMAGE_HEADER_BASE64_CHARS])
+    return Image.open(io.BytesIO(header)).size
+
+# Start a training iteration from the user message of a transcription request and its result
+def new_iteration(user_message, prompt, transcription):
+    image_block = user_message["content"][0]
+    width, height = image_block_size(image_block)
+    return {
+        "image": {
+            "media_type": image_block["source"]["media_type"],
+            "data": image_block["source"]["data"],
+            "width": width,
+            "height": height
+        },
+        "prompt": prompt,
+        "transcription": transcription,
+        "correction": None,
+        "reflection": None
+    }
+
+# Build the API image block for an iteration's image.
+# Profile blobs stay references until resolve_blob_refs reads them.
+def iteration_image_block(image):
+    if "blob" in image:
+        source = {"type": "profile_blob", "media_type": image["media_type"], "blob": image["blob"]}
+    else:
+        source = {"type": "base64", "media_type": image["media_type"], "data": image["data"]}
+    return {"type": "image", "source": source}
+
+# Render an iteration into API messages: the page and its transcription, followed by the
+# correction and the reflection on it once feedback has been given.
+# With text_only, only the correction and the reflection are rendered.
+def iteration_messages(iteration, text_only=False):
+    messages = []
+    if not text_only:
+        messages.append({
+            "role": "user",
+            "content": [iteration_image_block(iteration["image"]), {"type": "text", "text": iteration["prompt"]}]
+        })
+        messages.append({"role": "assistant", "content": iteration["transcription"]})
+    
+    if iteration["correction"] is not None:
+        messages.append({"role": "user", "content": feedback_prompt(iteration["correction"])})
+        messages.append({"role": "assistant", "content": iteration["reflection"]})
+    return messages
+
+# Render a list of iterations into API messages
+def render_iterations(iterations):
+    return [message for iteration in iterations for message in iteration_messages(iteration)]
+
+# Longest edge of the image previews in the training history viewer
+THUMBNAIL_LONG_EDGE = 240
+
+# A key identifying an iteration's image: its blob hash, or the hash of its inline data
+def iteration_image_key(image):
+    if "blob" in image:
+        return image["blob"]
+    return hashlib.sha256(image["data"].encode("ascii")).hexdigest()
+
+# Decode an iteration's image at a reduced size, for previews and similarity hashes
+def open_iteration_image(image, blob_store=None, long_edge=THUMBNAIL_LONG_EDGE):
+    data = blob_store.read(image["blob"]) if "blob" in image else base64.b64decode(image["data"])
+    with Image.open(io.BytesIO(data)) as img:
+        # JPEG pages are decoded at a reduced scale right away
+        img.draft("RGB", (long_edge, long_edge))
+        small = img.convert("RGB")
+    small.thumbnail((long_edge, long_edge))
+    return small
+
+# Make a small JPEG preview of an iteration's image
+def iteration_thumbnail(image, blob_store=None, long_edge=THUMBNAIL_LONG_EDGE):
+    thumbnail = open_iteration_image(image, blob_store, long_edge)
+    buffered = io.BytesIO()
+    thumbnail.save(buffered, format="JPEG", quality=80)
+    return buffered.getvalue()
+
+# Get the plain text of a message, ignoring images
+def message_text(message):
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return "\n".join(block["text"] for block in content if block.get("type") == "text")
+
+# Check if a message contains an image
+def has_image(message):
+    return isinstance(message["content"], list) and any(block.get("type") == "image" for block in message["content"])
+
+# Extract the correction from a feedback prompt
+def parse_feedback_prompt(text):
+    head, tail = FEEDBACK_PROMPT_TEMPLATE.split("{correction}")
+    if text.startswith(head) and text.endswith(tail):
+        return text[len(head):len(text) - len(tail)]
+    # Older prompts may differ in wording after the correction, so cut at the first instruction
+    end = text.find("\n\nJämför din transkription")
+    return text[len(head):end if end != -1 else len(text)].strip()
+
+# Convert a legacy flat message history into iterations.
+# Older versions recorded each iteration as 4 messages, or as 6 when the feedback exchange
+# was appended twice (once with a second copy of the image); both forms give one iteration.
+# The blob store is needed for version 2 archives whose images were saved without dimensions.
+def migrate_conversation_history(history, blob_store=None):
+    groups = []
+    for message in history:
+        starts_iteration = (
+            message["role"] == "user"
+            and has_image(message)
+            and not message_text(message).startswith(FEEDBACK_PROMPT_PREFIX)
+        )
+        if starts_iteration:
+            groups.append([])
+        if groups:
+            groups[-1].append(message)
+    
+    iterations = []
+    for group in groups:
+        if len(group) < 2:
+            continue
+        image_block = next(block for block in group[0]["content"] if block.get("type") == "image")
+        source = image_block["source"]
+        image = {"media_type": source["media_type"]}
+        if source["type"] == "profile_blob":
+            image["blob"] = source["blob"]
+        else:
+            image["data"] = source["data"]
+        image["width"], image["height"] = image_block_size(image_block, blob_store)
+        
+        iteration = {
+            "image": image,
+            "prompt": message_text(group[0]),
+            "transcription": message_text(group[1]),
+            "correction": None,
+            "reflection": None
+        }
+        for index, message in enumerate(group[2:-1], start=2):
+            if message["role"] == "user" and message_text(message).startswith(FEEDBACK_PROMPT_PREFIX):
+                iteration["correction"] = parse_feedback_prompt(message_text(message))
+                iteration["reflection"] = message_text(group[index + 1])
+                break
+        iterations.append(iteration)
+    return iterations
+
+# Training profiles are zip archives with a small JSON manifest of the iterations.
+# Each image is stored once as a binary blob named by its SHA-256 hash and
+# referenced from its iteration by that hash.
+# Version 2 archives and legacy JSON profiles stored flat message histories and
+# are migrated to iterations on load.
+PROFILE_FORMAT_VERSION = 3
+PROFILE_MANIFEST_NAME = "manifest.json"
+
+# Read-only access to the image blobs of a loaded training profile.
+# A blob is only read from the archive when a request that needs it is built.
+class ProfileBlobStore:
+    def __init__(self, archive):
+        self.archive = archive
+        self.encoded = {}
+        self.lock = threading.Lock()
+
+    def read(self, blob_hash):
+        with self.lock:
+            return self.archive.read(f"images/{blob_hash}")
+
+    def get_base64(self, blob_hash):
+        with self.lock:
+            if blob_hash not in self.encoded:
+                data = self.archive.read(f"images/{blob_hash}")
+                self.encoded[blob_hash] = base64.b64encode(data).decode("utf-8")
+            return self.encoded[blob_hash]
+
+# Check if a content block is an image stored as a profile blob
+def is_blob_ref(block):
+    return block.get("type") == "image" and block["source"].get("type") == "profile_blob"
+
+# Replace profile blob references in messages with the base64 data the API expects
+def resolve_blob_refs(messages, blob_store):
+    resolved = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list) and any(is_blob_ref(block) for block in content):
+            content = [
+                {
+                    **block,
+                    "source": {
+                        "type": "base64",
+                        "media_type": block["source"]["media_type"],
+                        "data": blob_store.get_base64(block["source"]["blob"])
+                    }
+                } if is_blob_ref(block) else block
+                for block in content
+            ]
+            message = {**message, "content": content}
+        resolved.append(message)
+    return resolved
+
+# Collect an iteration image's data in the blob table and return an image referencing it
+def image_to_blob_ref(image, blobs, blob_store):
+    if "blob" in image:
+        blob_hash = image["blob"]
+        if blob_hash not in blobs:
+            blobs[blob_hash] = blob_store.read(blob_hash)
+    else:
+        data = base64.b64decode(image["data"])
+        blob_hash = hashlib.sha256(data).hexdigest()
+        blobs[blob_hash] = data
+    
+    return {
+        "media_type": image["media_type"],
+        "blob": blob_hash,
+        "width": image["width"],
+        "height": image["height"]
+    }
+
+# Serialize training iterations and their metadata into a compact profile archive
+def serialize_profile(iterations, metadata, blob_store=None):
+    blobs = {}
+    manifest_iterations = [
+        {**iteration, "image": image_to_blob_ref(iteration["image"], blobs, blob_store)}
+        for iteration in iterations
+    ]
+    
+    manifest = {
+        "format_version": PROFILE_FORMAT_VERSION,
+        "iterations": manifest_iterations,
+        "metadata": metadata
+    }
+    
+    # Images are already compressed, so only the manifest is deflated
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr(PROFILE_MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False), compress_type=zipfile.ZIP_DEFLATED)
+        for blob_hash, data in blobs.items():
+            archive.writestr(f"images/{blob_hash}", data)
+    return buffer.getvalue()
+
+# Parse a profile archive or a legacy JSON profile.
+# Returns the iterations, the metadata and the blob store for the archive's images (None for legacy files).
+def parse_profile(profile_data):
+    if zipfile.is_zipfile(io.BytesIO(profile_data)):
+        archive = zipfile.ZipFile(io.BytesIO(profile_data))
+        data = json.loads(archive.read(PROFILE_MANIFEST_NAME).decode("utf-8"))
+        blob_store = ProfileBlobStore(archive)
+    else:
+        # Legacy format: a single JSON document with the images inlined as base64
+        data = json.loads(profile_data.decode("utf-8"))
+        blob_store = None
+    
+    if "iterations" in data:
+        iterations = data["iterations"]
+    else:
+        iterations = migrate_conversation_history(data["conversation_history"], blob_store)
+    return iterations, data["metadata"], blob_store
+
+# Load a training profile from disk
+def load_profile_file(path):
+    with open(path, "rb") as f:
+        return parse_profile(f.read())
+
+# Return a copy of the history with a prompt-cache breakpoint on its last content block,
+# so the whole training prefix can be reused by later calls
+def with_cache_breakpoint(history):
+    if not history:
+        return list(history)
+    
+    last_message = history[-1]
+    content = last_message["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [dict(block) for block in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    
+    return list(history[:-1]) + [{"role": last_message["role"], "content": content}]
+
+# Prompt used to condense older training iterations into lessons learned
+LESSONS_SUMMARY_PROMPT = """Nedan följer korrigeringar och dina reflektioner från tidigare träningsiterationer där du transkriberat handskrivna manuskript.
+
+Sammanfatta de viktigaste lärdomarna som en koncis punktlista: typiska fel, svårtydda bokstavsformer, förkortningar, stavningsmönster och språkliga särdrag. Sammanfattningen ska användas som vägledning vid framtida transkriptioner av liknande manuskript.
+
+"""
+
+# Rough token estimate for text
+def estimate_text_tokens(text):
+    return len(text) // 3 + 1
+
+# Rough token estimate for an image after the API has scaled it down
+def estimate_image_tokens(width, height):
+    scale = min(1.0, MAX_USEFUL_LONG_EDGE / max(width, height))
+    return min(MAX_IMAGE_TOKENS, int(width * scale * height * scale / 750))
+
+# Rough token estimate for a text-only message
+def estimate_message_tokens(message):
+    return estimate_text_tokens(message_text(message))
+
+# Rough token estimate for an iteration as it is rendered into messages
+def estimate_iteration_tokens(iteration, text_only=False):
+    tokens = sum(estimate_message_tokens(message) for message in iteration_messages(iteration, text_only))
+    if not text_only:
+        tokens += estimate_image_tokens(iteration["image"]["width"], iteration["image"]["height"])
+    return tokens
+
+# Replace older iterations with a condensed lessons-learned exchange.
+# Summaries are stored in summary_cache, so each set of iterations is only summarized once.
+def lessons_summary_messages(iterations, client, summary_cache):
+    corrections = [
+        message_text(message)
+        for iteration in iterations
+        for message in iteration_messages(iteration, text_only=True)
+    ]
+    if not corrections:
+        return []
+    
+    summary_key = hashlib.sha256("\n".join(corrections).encode("utf-8")).hexdigest()
+    if summary_key not in summary_cache:
+        messages = [{"role": "user", "content": LESSONS_SUMMARY_PROMPT + "\n\n".join(corrections)}]
+        result = send_request("summary", client, messages, {"max_tokens": 1000, "max_continuations": 0})
+        summary_cache[summary_key] = result["transcription"]
+    
+    return [
+        {
+            "role": "user",
+            "content": f"Sammanfattning av lärdomar från tidigare träningsiterationer:\n\n{summary_cache[summary_key]}"
+        },
+        {
+            "role": "assistant",
+            "content": "Jag kommer att tillämpa dessa lärdomar i kommande transkriptioner."
+        }
+    ]
+
+# Side of the grid a page is reduced to for its similarity hash
+HASH_SIZE = 16
+
+# Perceptual hash of an image, from a small grayscale version of it: a difference hash (whether
+# each cell is brighter than its right neighbour) followed by an average hash (whether each cell
+# is brighter than the mean). The first follows edges such as ruling and columns, the second
+# where the ink and dark areas are. Pages with a similar layout get hashes that differ in few bits.
+def image_hash(img):
+    small = img.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR, reducing_gap=2.0).convert("L")
+    pixels = list(small.getdata())
+    rows = [pixels[row * (HASH_SIZE + 1):(row + 1) * (HASH_SIZE + 1)] for row in range(HASH_SIZE)]
+    mean = sum(pixels) / len(pixels)
+    bits = 0
+    for row in rows:
+        for left, right in zip(row, row[1:]):
+            bits = (bits << 1) | (left > right)
+    for row in rows:
+        for value in row[:HASH_SIZE]:
+            bits = (bits << 1) | (value > mean)
+    return bits
+
+# Number of differing bits between two hashes
+def hash_distance(a, b):
+    return bin(a ^ b).count("1")
+
+# Similarity hashes of training images by image key, shared by everything in this process
+_iteration_hashes = {}
+_iteration_hashes_lock = threading.Lock()
+
+# Similarity hashes of the images of training iterations, computed once per image and process
+def iteration_hashes(iterations, blob_store=None):
+    hashes = []
+    for iteration in iterations:
+        key = iteration_image_key(iteration["image"])
+        with _iteration_hashes_lock:
+            value = _iteration_hashes.get(key)
+        if value is None:
+            value = image_hash(open_iteration_image(iteration["image"], blob_store))
+            with _iteration_hashes_lock:
+                _iteration_hashes[key] = value
+        hashes.append(value)
+    return hashes
+
+# Select training iterations according to the history policy, fit them into the token budget
+# and render them into API messages.
+# The budget reserves room for the page being transcribed, so the trimmed prefix is the same
+# for every page of a batch and stays cacheable.
+# The "similar" mode depends on the page and is applied per page by an ExampleSelector; calls
+# without a page, such as feedback, keep the latest iterations like "last_n".
+def apply_history_policy(iterations, policy, prompt, client, summary_cache=None):
+    if summary_cache is None:
+        summary_cache = {}
+    
+    keep = max(1, policy["keep_iterations"])
+    older, recent = iterations[:-keep], iterations[-keep:]
+    
+    # Each kept iteration is paired with whether it is rendered as text only
+    prefix = []
+    if policy["mode"] in ("last_n", "similar"):
+        kept = [(iteration, False) for iteration in recent]
+    elif policy["mode"] == "text_only":
+        kept = [(iteration, True) for iteration in older if iteration["correction"] is not None]
+        kept += [(iteration, False) for iteration in recent]
+    elif policy["mode"] == "summary":
+        prefix = lessons_summary_messages(older, client, summary_cache) if older else []
+        kept = [(iteration, False) for iteration in recent]
+    else:
+        kept = [(iteration, False) for iteration in iterations]
+    
+    # Drop the oldest iterations until the request fits the budget, always keeping the latest one
+    costs = [estimate_iteration_tokens(iteration, text_only) for iteration, text_only in kept]
+    total = (
+        MAX_IMAGE_TOKENS
+        + estimate_text_tokens(prompt)
+        + sum(estimate_message_tokens(message) for message in prefix)
+        + sum(costs)
+    )
+    while total > policy["token_budget"] and len(kept) > 1:
+        total -= costs.pop(0)
+        kept.pop(0)
+    
+    return prefix + [
+        message
+        for iteration, text_only in kept
+        for message in iteration_messages(iteration, text_only)
+    ]
+
+# Fingerprint of the iterations and history policy a training history is rendered from.
+# Page keys use it instead of the rendered history, which in the "summary" mode contains a
+# summary the model writes anew on each run.
+def history_fingerprint(iterations, policy):
+    settings = {
+        "iterations": [
+            [
+                iteration_image_key(iteration["image"]),
+                iteration["prompt"],
+                iteration["transcription"],
+                iteration["correction"],
+                iteration["reflection"]
+            ]
+            for iteration in iterations
+        ],
+        "policy": policy
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# Chooses the training examples of each page for the "similar" history mode: the
+# keep_iterations completed iterations whose images look most like the page, trimmed to the
+# token budget starting with the least similar. The hashes of the training images are
+# computed when the first page is selected for, and reused from the process-wide cache.
+class ExampleSelector:
+    def __init__(self, iterations, policy, prompt, blob_store=None):
+        completed = [iteration for iteration in iterations if iteration["correction"] is not None]
+        self.completed = completed
+        self.blob_store = blob_store
+        self.examples = None
+        self.lock = threading.Lock()
+        self.policy = policy
+        self.prompt = prompt
+        settings = {
+            "examples": [iteration_image_key(iteration["image"]) for iteration in completed],
+            "keep_iterations": policy["keep_iterations"],
+            "token_budget": policy["token_budget"]
+        }
+        self.fingerprint = hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+    # The training iterations paired with the hashes of their images
+    def hashed_examples(self):
+        with self.lock:
+            if self.examples is None:
+                self.examples = list(zip(self.completed, iteration_hashes(self.completed, self.blob_store)))
+            return self.examples
+
+    # The most similar iterations to a page, least similar first
+    def select(self, image):
+        page_hash = image_hash(image)
+        ranked = sorted(self.hashed_examples(), key=lambda example: hash_distance(example[1], page_hash), reverse=True)
+        return [iteration for iteration, _ in ranked[-max(1, self.policy["keep_iterations"]):]]
+
+    # The training history to send with a page, rendered into API messages
+    def history(self, image):
+        return apply_history_policy(self.select(image), {**self.policy, "mode": "all"}, self.prompt, None)
+
+# Output limits for a page: tokens per call, and how many continuation calls may
+# follow a response that was cut off at the token limit
+DEFAULT_OUTPUT_LIMITS = {
+    "max_tokens": 1000,
+    "max_continuations": 3
+}
+
+# Extract the token counts of a response, including prompt-cache reads and writes
+def usage_summary(response):
+    usage = response.usage
+    return {
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cache_read_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+        "cache_write_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0
+    }
+
+# Add up the token counts of several calls
+def add_usage(total, usage):
+    return {key: total[key] + usage[key] for key in total}
+
+# Get the text of a response
+def response_text(response):
+    return "".join(block.text for block in response.content if block.type == "text")
+
+# Call the Messages API, streaming the text to on_text if it is given
+def request_message(client, messages, max_tokens, on_text=None, model=MODEL):
+    if on_text is not None:
+        with client.messages.stream(model=model, max_tokens=max_tokens, messages=messages) as stream:
+            for text in stream.text_stream:
+                on_text(text)
+            return stream.get_final_message()
+    return client.messages.create(
+        model=model,
+        max_tokens=max_tokens,
+        messages=messages
+    )
+
+# Continue a response that stopped at max_tokens by sending the partial text back as
+# the start of the assistant turn, until the model finishes or no continuations are left.
+# Returns the full text, the summed usage, the number of continuation calls and
+# whether the text is still truncated.
+def complete_transcription(client, messages, response, output_limits, on_text=None, model=MODEL):
+    text = response_text(response)
+    usage = usage_summary(response)
+    continuations = 0
+    
+    while response.stop_reason == "max_tokens" and continuations < output_limits["max_continuations"]:
+        # The API rejects a prefilled assistant turn that ends with whitespace
+        text = text.rstrip()
+        if not text:
+            break
+        continuations += 1
+        response = request_message(
+            client,
+            messages + [{"role": "assistant", "content": text}],
+            output_limits["max_tokens"],
+            on_text,
+            model
+        )
+        text += response_text(response)
+        usage = add_usage(usage, usage_summary(response))
+    
+    return {
+        "transcription": text,
+        "usage": usage,
+        "continuations": continuations,
+        "truncated": response.stop_reason == "max_tokens"
+    }
+
+# Prices in US dollars per million tokens, used to estimate the cost of each call
+MODEL_PRICES = {
+    "claude-3-5-sonnet-20241022": {
+        "input_tokens": 3.0,
+        "output_tokens": 15.0,
+        "cache_read_tokens": 0.30,
+        "cache_write_tokens": 3.75
+    },
+    "claude-3-haiku-20240307": {
+        "input_tokens": 0.25,
+        "output_tokens": 1.25,
+        "cache_read_tokens": 0.03,
+        "cache_write_tokens": 0.30
+    }
+}
+
+# Message Batches are billed at half the regular price
+BATCH_PRICE_FACTOR = 0.5
+
+# Estimated cost of a call's token usage in US dollars, or None for a model without known prices
+def estimate_cost(usage, model=MODEL, batch=False):
+    prices = MODEL_PRICES.get(model)
+    if prices is None or usage is None:
+        return None
+    cost = sum(usage[key] * price for key, price in prices.items()) / 1_000_000
+    return cost * BATCH_PRICE_FACTOR if batch else cost
+
+# Approximate size of a request: the text and base64 image data of its messages
+def payload_bytes(messages):
+    size = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            size += len(content.encode("utf-8"))
+            continue
+        for block in content:
+            if block.get("type") == "image":
+                size += len(block["source"]["data"])
+            elif block.get("type") == "text":
+                size += len(block["text"].encode("utf-8"))
+    return size
+
+# Number of recent calls kept for the rolling aggregates
+METRICS_WINDOW = 500
+
+# Default location of the metrics log
+DEFAULT_METRICS_LOG_PATH = os.path.join(os.path.expanduser("~"), ".transcription", "metrics.jsonl")
+
+# Fields of a metrics entry that are added up in the running totals
+METRIC_SUM_FIELDS = [
+    "api_calls",
+    "retries",
+    "encode_seconds",
+    "payload_bytes",
+    "latency_seconds",
+    "input_tokens",
+    "output_tokens",
+    "cache_read_tokens",
+    "cache_write_tokens",
+    "cost_usd"
+]
+
+# Build the metrics entry of a request. A request may consist of several API calls when the
+# response is continued; latency is the time spent waiting for all of them.
+# usage is None when the request failed, and latency is None for batch results.
+# attempt is the number of earlier attempts at the same request. Every attempt gets its own
+# entry, so an entry counts as one retry when it is not the first attempt, and the retries of
+# a page add up to its number of attempts less one.
+def call_metrics(kind, encode_seconds, payload, latency, usage, api_calls=1, attempt=0, error=None, batch=False, model=MODEL):
+    if error is None:
+        status = "ok"
+    else:
+        status = str(getattr(error, "status_code", None) or type(error).__name__)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "kind": kind,
+        "model": model,
+        "status": status,
+        "encode_seconds": round(encode_seconds, 4),
+        "payload_bytes": payload,
+        "latency_seconds": None if latency is None else round(latency, 4),
+        "api_calls": api_calls,
+        "attempt": attempt,
+        "retries": 1 if attempt else 0,
+        **(usage or {"input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0}),
+        "cost_usd": estimate_cost(usage, model, batch)
+    }
+
+# Value at a percentile of sorted values (nearest rank), or None without values
+def percentile(values, percent):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+# Process-wide record of API requests: running totals, a rolling window of recent
+# requests for aggregates, and optionally a JSON lines log with one entry per request
+class MetricsRecorder:
+    def __init__(self, window=METRICS_WINDOW):
+        self.recent = deque(maxlen=window)
+        self.totals = dict.fromkeys(["calls", "errors"] + METRIC_SUM_FIELDS, 0)
+        self.model_totals = {}
+        self.log_path = None
+        self.log_file = None
+        self.lock = threading.Lock()
+
+    # Append every entry to a JSON lines file from now on; None stops logging
+    def set_log_path(self, path):
+        with self.lock:
+            if path == self.log_path:
+                return
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+            self.log_path = path
+            if path:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self.log_file = open(path, "a", encoding="utf-8")
+
+    def record(self, entry):
+        with self.lock:
+            self.recent.append(entry)
+            self.totals["calls"] += 1
+            if entry["status"] != "ok":
+                self.totals["errors"] += 1
+            for field in METRIC_SUM_FIELDS:
+                self.totals[field] += entry[field] or 0
+            model_totals = self.model_totals.setdefault(entry["model"], {"calls": 0, "cost_usd": 0})
+            model_totals["calls"] += 1
+            model_totals["cost_usd"] += entry["cost_usd"] or 0
+            if self.log_file is not None:
+                self.log_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self.log_file.flush()
+
+    # Running totals over all requests since the process started
+    def total_counts(self):
+        with self.lock:
+            return dict(self.totals)
+
+    # Running request counts and costs of each model
+    def model_counts(self):
+        with self.lock:
+            return {model: dict(totals) for model, totals in self.model_totals.items()}
+
+    # Aggregates over the recent requests
+    def summary(self):
+        with self.lock:
+            recent = list(self.recent)
+        succeeded = [entry for entry in recent if entry["status"] == "ok"]
+        latencies = sorted(entry["latency_seconds"] for entry in succeeded if entry["latency_seconds"] is not None)
+        summary = {
+            "calls": len(recent),
+            "errors": len(recent) - len(succeeded),
+            "retries": sum(entry["retries"] for entry in recent),
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+            "encode_seconds_mean": sum(entry["encode_seconds"] for entry in recent) / len(recent) if recent else None,
+            "payload_bytes_mean": sum(entry["payload_bytes"] for entry in recent) / len(recent) if recent else None,
+            "cost_usd": sum(entry["cost_usd"] or 0 for entry in recent)
+        }
+        for field in ["input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens"]:
+            summary[field] = sum(entry[field] for entry in recent)
+        
+        # Calls, latency and cost of each model, to compare the tiers of a cascade
+        summary["models"] = {}
+        for model in sorted({entry["model"] for entry in recent}):
+            entries = [entry for entry in recent if entry["model"] == model]
+            model_latencies = sorted(entry["latency_seconds"] for entry in entries if entry["status"] == "ok" and entry["latency_seconds"] is not None)
+            summary["models"][model] = {
+                "calls": len(entries),
+                "latency_p50": percentile(model_latencies, 50),
+                "cost_usd": sum(entry["cost_usd"] or 0 for entry in entries)
+            }
+        return summary
+
+    # Running totals and recent latency percentiles in the Prometheus text format
+    def prometheus_text(self):
+        totals = self.total_counts()
+        summary = self.summary()
+        lines = []
+        for name, value in [
+            ("transcription_requests_total", totals["calls"]),
+            ("transcription_request_errors_total", totals["errors"]),
+            ("transcription_api_calls_total", totals["api_calls"]),
+            ("transcription_retries_total", totals["retries"]),
+            ("transcription_encode_seconds_total", totals["encode_seconds"]),
+            ("transcription_payload_bytes_total", totals["payload_bytes"]),
+            ("transcription_latency_seconds_total", totals["latency_seconds"]),
+            ("transcription_cost_usd_total", totals["cost_usd"])
+        ]:
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+        lines.append("# TYPE transcription_tokens_total counter")
+        for field in ["input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens"]:
+            lines.append(f'transcription_tokens_total{{type="{field[:-len("_tokens")]}"}} {totals[field]}')
+        model_counts = self.model_counts()
+        lines.append("# TYPE transcription_model_requests_total counter")
+        for model, counts in model_counts.items():
+            lines.append(f'transcription_model_requests_total{{model="{model}"}} {counts["calls"]}')
+        lines.append("# TYPE transcription_model_cost_usd_total counter")
+        for model, counts in model_counts.items():
+            lines.append(f'transcription_model_cost_usd_total{{model="{model}"}} {counts["cost_usd"]}')
+        lines.append("# TYPE transcription_recent_latency_seconds gauge")
+        for quantile, field in [("0.5", "latency_p50"), ("0.95", "latency_p95")]:
+            if summary[field] is not None:
+                lines.append(f'transcription_recent_latency_seconds{{quantile="{quantile}"}} {summary[field]}')
+        return "\n".join(lines) + "\n"
+
+# The metrics are shared by everything running in this process
+_metrics = MetricsRecorder()
+
+def get_metrics():
+    return _metrics
+
+# Serve the metrics in the Prometheus text format at http://host:port/metrics from a background thread
+def start_metrics_server(port, host="127.0.0.1"):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = get_metrics().prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("content-type", "text/plain; version=0.0.4")
+            self.send_header("content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Build the messages for transcribing an image with the training history as context.
+# Returns the messages for the API call and the new user message on its own.
+def build_transcription_messages(image, prompt, history, cache_history=False, preprocessing=None, blob_store=None, encoding_cache=None):
+    base64_image, media_type = image_to_base64(image, preprocessing, encoding_cache)
+    
+    # Construct the complete message history for context
+    messages = []
+    
+    # Add all previous conversation history, marked as a cacheable prefix if requested
+    if cache_history:
+        messages.extend(with_cache_breakpoint(history))
+    else:
+        messages.extend(history)
+    
+    # Create the user message with the current image and prompt
+    user_message = {
+        "role": "user",
+        "content": [
+            {
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": media_type,
+                    "data": base64_image
+                }
+            },
+            {
+                "type": "text",
+                "text": prompt
+            }
+        ]
+    }
+    
+    # Add to the messages for the API call
+    messages.append(user_message)
+    
+    # Read the images of a loaded profile only now that the request is built
+    if blob_store is not None:
+        messages = resolve_blob_refs(messages, blob_store)
+    
+    return messages, user_message
+
+# Transcribe an image with the training history as context.
+# The history is sent as given, so callers apply the history policy first.
+# Returns a dict with the transcription, the token usage, the number of continuation
+# calls, whether the output is still truncated, and the user message that was sent,
+# from which training mode starts a new iteration.
+# If on_text is given, the response is streamed and on_text is called with each piece of text.
+# encoding_cache replaces the process-wide encoding cache, as in image_to_base64.
+def process_transcription(image, prompt, history, client, cache_history=False, preprocessing=None, blob_store=None, on_text=None, output_limits=None, attempt=0, model=MODEL, encoding_cache=None):
+    if output_limits is None:
+        output_limits = DEFAULT_OUTPUT_LIMITS
+
+    started = time.perf_counter()
+    messages, user_message = build_transcription_messages(
+        image,
+        prompt,
+        history,
+        cache_history=cache_history,
+        preprocessing=preprocessing,
+        blob_store=blob_store,
+        encoding_cache=encoding_cache
+    )
+    encode_seconds = time.perf_counter() - started
+    
+    # Call Claude API, continuing the transcription if it hits the token limit
+    result = send_request("transcription", client, messages, output_limits, on_text, encode_seconds, attempt, model)
+    result["user_message"] = user_message
+    return result
+
+# Ask Claude to reflect on the user's correction of the latest transcription.
+# The history must end with the iteration being corrected, rendered without feedback.
+# Returns the same dict as complete_transcription, with the reflection as "transcription".
+def process_feedback(correction, history, client, blob_store=None, on_text=None, output_limits=None, model=MODEL):
+    if output_limits is None:
+        output_limits = DEFAULT_OUTPUT_LIMITS
+    
+    started = time.perf_counter()
+    messages = list(history) + [{"role": "user", "content": feedback_prompt(correction)}]
+    if blob_store is not None:
+        messages = resolve_blob_refs(messages, blob_store)
+    encode_seconds = time.perf_counter() - started
+    
+    return send_request("feedback", client, messages, output_limits, on_text, encode_seconds, model=model)
+
+# Send a request, continue it if it stops at the token limit, and record its metrics.
+# encode_seconds is the time it took to build the messages, and attempt the number of
+# earlier attempts that were rate limited.
+def send_request(kind, client, messages, output_limits, on_text=None, encode_seconds=0.0, attempt=0, model=MODEL):
+    payload = payload_bytes(messages)
+    started = time.perf_counter()
+    try:
+        response = request_message(client, messages, output_limits["max_tokens"], on_text, model)
+        result = complete_transcription(client, messages, response, output_limits, on_text, model)
+    except Exception as e:
+        get_metrics().record(call_metrics(kind, encode_seconds, payload, time.perf_counter() - started, None, attempt=attempt, error=e, model=model))
+        raise
+    
+    get_metrics().record(call_metrics(
+        kind,
+        encode_seconds,
+        payload,
+        time.perf_counter() - started,
+        result["usage"],
+        api_calls=1 + result["continuations"],
+        attempt=attempt,
+        model=model
+    ))
+    return result
+
+# HTTP status codes where the API asks us to slow down (rate limit and overload)
+RATE_LIMIT_STATUS_CODES = (429, 529)
+
+# Retry behaviour of bulk runs. Calls that time out, lose their connection or get a rate limit,
+# overload or server error are retried with jittered exponential backoff, at most max_attempts
+# times per page. After breaker_threshold such failures in a row, counted across all workers,
+# the circuit breaker opens and the whole run pauses for breaker_cooldown seconds before a
+# single probe call is let through (a threshold of 0 disables the breaker).
+# With retry_failed, pages that still fail get one more round of attempts at the end of the run.
+DEFAULT_RETRY_POLICY = {
+    "timeout": REQUEST_TIMEOUT,
+    "max_attempts": 6,
+    "base_delay": 1.0,
+    "max_delay": 60.0,
+    "breaker_threshold": 5,
+    "breaker_cooldown": 60.0,
+    "retry_failed": True
+}
+
+# Check if a failed call is worth retrying: timeouts, connection errors, rate limits and server errors
+def is_retryable_error(error):
+    import anthropic
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    return isinstance(error, anthropic.APIStatusError) and (
+        error.status_code in RATE_LIMIT_STATUS_CODES or error.status_code >= 500
+    )
+
+# Concurrency limiter shared by the bulk workers. The number of in-flight calls is
+# halved and all workers pause when a call has to be retried, and the limit
+# grows back one step at a time while calls keep succeeding.
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.active = 0
+        self.successes = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.active < self.limit:
+                    self.active += 1
+                    return
+                self.condition.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, backoff=None):
+        with self.condition:
+            self.active -= 1
+            if backoff is not None:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+            else:
+                self.successes += 1
+                if self.limit < self.max_concurrency and self.successes >= self.limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+# Circuit breaker shared by the bulk workers. It opens after threshold retryable failures in a
+# row and then holds back every call for the cooldown, after which one call at a time is let
+# through as a probe. A call that gets an answer from the API closes it again, and a failed
+# probe opens it for another cooldown.
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+        self.times_opened = 0
+        self.condition = threading.Condition()
+
+    # Block until a call may be made
+    def wait(self):
+        with self.condition:
+            while True:
+                if self.open_until is None:
+                    return
+                remaining = self.open_until - time.monotonic()
+                if remaining <= 0 and not self.probing:
+                    self.probing = True
+                    return
+                self.condition.wait(timeout=remaining if remaining > 0 else None)
+
+    def record_success(self):
+        with self.condition:
+            self.failures = 0
+            self.open_until = None
+            self.probing = False
+            self.condition.notify_all()
+
+    # Let another call probe the API, when a call failed before reaching it
+    def release_probe(self):
+        with self.condition:
+            self.probing = False
+            self.condition.notify_all()
+
+    def record_failure(self):
+        with self.condition:
+            self.failures += 1
+            if self.probing or (self.open_until is None and 0 < self.threshold <= self.failures):
+                self.open_until = time.monotonic() + self.cooldown
+                self.probing = False
+                self.times_opened += 1
+                logger.warning(
+                    "API:et svarar inte (%d misslyckade anrop i rad), pausar alla anrop i %.0f s",
+                    self.failures, self.cooldown
+                )
+            self.condition.notify_all()
+
+# Compute how long to wait before retrying a failed call, honoring the retry-after header if present
+def retry_delay(error, attempt, base_delay=1.0, max_delay=60.0):
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(max_delay, float(retry_after))
+    except (TypeError, ValueError):
+        return min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+# Makes the API calls of a bulk run: within the adaptive concurrency limit, behind the
+# circuit breaker, and retried according to the retry policy.
+# A limiter and breaker can be given to share them with other runs, as the job queue does.
+class RequestExecutor:
+    def __init__(self, max_concurrency, retry_policy=None, limiter=None, breaker=None):
+        self.policy = retry_policy or DEFAULT_RETRY_POLICY
+        self.limiter = limiter or AdaptiveConcurrencyLimiter(max_concurrency)
+        self.breaker = breaker or CircuitBreaker(self.policy["breaker_threshold"], self.policy["breaker_cooldown"])
+
+    # Make a call, retrying it while it fails with retryable errors.
+    # call is given the number of the attempt, counted from 0.
+    def run(self, call):
+        max_attempts = self.policy["max_attempts"]
+        for attempt in range(max_attempts):
+            self.breaker.wait()
+            self.limiter.acquire()
+            try:
+                result = call(attempt)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    import anthropic
+                    self.limiter.release()
+                    if isinstance(e, anthropic.APIStatusError):
+                        # The API answered, so it is up even though the request was refused
+                        self.breaker.record_success()
+                    else:
+                        self.breaker.release_probe()
+                    raise
+                self.limiter.release(backoff=retry_delay(e, attempt, self.policy["base_delay"], self.policy["max_delay"]))
+                self.breaker.record_failure()
+                if attempt == max_attempts - 1:
+                    raise
+                continue
+            self.limiter.release()
+            self.breaker.record_success()
+            return result
+
+# Model routing of bulk runs. Without the cascade, every page goes to model. With it, each page
+# goes to fast_model first and is escalated to model only when the fast result looks unreliable:
+# it was cut off at the token limit, it has more than max_uncertain words marked as uncertain,
+# or, with double_check, a second fast pass agrees with the first less than min_agreement.
+DEFAULT_ROUTING = {
+    "model": MODEL,
+    "cascade": False,
+    "fast_model": FAST_MODEL,
+    "max_uncertain": 0,
+    "double_check": False,
+    "min_agreement": 0.9
+}
+
+# Written by the fast model after words it is unsure of in cascade mode
+UNCERTAINTY_MARKER = "[?]"
+
+# Added to the prompt of the fast passes, asking the model to mark uncertain words
+UNCERTAINTY_PROMPT_SUFFIX = f"\n\nOm du är osäker på hur ett ord ska läsas, skriv {UNCERTAINTY_MARKER} direkt efter ordet."
+
+# Remove the uncertainty markers from an accepted fast transcription
+def strip_uncertainty_markers(text):
+    return text.replace(" " + UNCERTAINTY_MARKER, "").replace(UNCERTAINTY_MARKER, "")
+
+# Find why a fast pass should be escalated, or None if it can be accepted
+def escalation_reason(result, routing):
+    if result["truncated"]:
+        return "truncated"
+    if result["transcription"].count(UNCERTAINTY_MARKER) > routing["max_uncertain"]:
+        return "uncertain"
+    return None
+
+# Transcribe an image with the model chosen by the routing settings, escalating it from the
+# fast model to the selected one in cascade mode. call makes a request from a function of the
+# attempt number, so bulk runs can send every pass through their request executor.
+# Returns the result of the last pass with the usage and continuations of all passes added up,
+# plus the model that produced the text, the tier ("single", "fast" or "escalated") and the
+# reason for an escalation.
+def transcribe_routed(image, prompt, history, client, routing=None, call=None, **options):
+    if routing is None:
+        routing = DEFAULT_ROUTING
+    if call is None:
+        call = lambda request: request(0)
+    
+    def transcribe(model, text):
+        return call(lambda attempt: process_transcription(image, text, history, client, attempt=attempt, model=model, **options))
+    
+    if not routing["cascade"]:
+        return {**transcribe(routing["model"], prompt), "model": routing["model"], "tier": "single", "escalation": None}
+    
+    fast_prompt = prompt + UNCERTAINTY_PROMPT_SUFFIX
+    passes = [transcribe(routing["fast_model"], fast_prompt)]
+    escalation = escalation_reason(passes[0], routing)
+    if escalation is None and routing["double_check"]:
+        passes.append(transcribe(routing["fast_model"], fast_prompt))
+        escalation = escalation_reason(passes[1], routing)
+        agreement = difflib.SequenceMatcher(
+            None,
+            strip_uncertainty_markers(passes[0]["transcription"]),
+            strip_uncertainty_markers(passes[1]["transcription"])
+        ).ratio()
+        if escalation is None and agreement < routing["min_agreement"]:
+            escalation = "disagreement"
+    
+    if escalation is None:
+        result = {
+            **passes[0],
+            "transcription": strip_uncertainty_markers(passes[0]["transcription"]),
+            "model": routing["fast_model"],
+            "tier": "fast",
+            "escalation": None
+        }
+    else:
+        passes.append(transcribe(routing["model"], prompt))
+        result = {**passes[-1], "model": routing["model"], "tier": "escalated", "escalation": escalation}
+    
+    usage = passes[0]["usage"]
+    for earlier in passes[1:]:
+        usage = add_usage(usage, earlier["usage"])
+    result["usage"] = usage
+    result["continuations"] = sum(earlier["continuations"] for earlier in passes)
+    return result
+
+# Tiling splits tall pages into overlapping horizontal bands that are transcribed separately,
+# so large folio scans keep more of their resolution than when sent as a single image.
+# Only pages taller than min_height pixels are tiled.
+DEFAULT_TILING = {
+    "enabled": False,
+    "bands": 3,
+    "overlap": 0.15,
+    "min_height": 2 * MAX_USEFUL_LONG_EDGE
+}
+
+# Added in front of the prompt for each band
+TILE_PROMPT_PREFIX = "Bilden är del {number} av {count} av en manuskriptsida som delats upp i horisontella band som överlappar varandra något. Transkribera all text som syns i denna del, även rader som är delvis avskurna i över- eller underkanten.\n\n"
+
+# Shortest common text accepted as the overlap between two bands
+MIN_STITCH_OVERLAP_CHARS = 12
+
+# Check if tiling applies to an image
+def should_tile(image, tiling):
+    return bool(tiling) and tiling["enabled"] and tiling["bands"] > 1 and image.height > tiling["min_height"]
+
+# Split an image into overlapping horizontal bands, from top to bottom
+def split_into_bands(image, bands, overlap):
+    band_height = image.height / (1 + (bands - 1) * (1 - overlap))
+    step = band_height * (1 - overlap)
+    return [
+        image.crop((0, round(index * step), image.width, min(image.height, round(index * step + band_height))))
+        for index in range(bands)
+    ]
+
+# Join the transcriptions of two neighbouring bands, keeping the text they share only once.
+# The overlap is the longest common text between the end of the upper band and the start of
+# the lower one; half-visible lines around it are dropped from both sides.
+def stitch_pair(upper, lower, overlap):
+    window = int(max(len(upper), len(lower)) * min(1.0, 2 * overlap)) + 100
+    tail_start = max(0, len(upper) - window)
+    tail = upper[tail_start:]
+    head = lower[:window]
+    
+    match = difflib.SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+    if match.size < MIN_STITCH_OVERLAP_CHARS:
+        return upper.rstrip() + "\n" + lower.lstrip()
+    return upper[:tail_start + match.a + match.size] + lower[match.b + match.size:]
+
+# Stitch band transcriptions from top to bottom into the text of the whole page
+def stitch_transcriptions(texts, overlap):
+    stitched = texts[0]
+    for text in texts[1:]:
+        stitched = stitch_pair(stitched, text, overlap)
+    return stitched
+
+# Transcribe a tall page as overlapping bands in parallel and stitch the results together.
+# With a request executor, every band call goes through it, so tiled pages share the
+# concurrency limit, circuit breaker and retries of a bulk run.
+# Each band is routed on its own; the page counts as escalated if any of its bands was.
+# Returns the same dict as transcribe_routed without the user message, plus the number of tiles.
+def transcribe_tiled(image, prompt, history, client, tiling, cache_history=False, preprocessing=None, blob_store=None, output_limits=None, executor=None, routing=None, encoding_cache=None):
+    if routing is None:
+        routing = DEFAULT_ROUTING
+    bands = split_into_bands(image, tiling["bands"], tiling["overlap"])
+    
+    def transcribe_band(number, band):
+        return transcribe_routed(
+            band,
+            TILE_PROMPT_PREFIX.format(number=number, count=len(bands)) + prompt,
+            history,
+            client,
+            routing,
+            call=executor.run if executor is not None else None,
+            cache_history=cache_history,
+            preprocessing=preprocessing,
+            blob_store=blob_store,
+            output_limits=output_limits,
+            encoding_cache=encoding_cache
+        )
+    
+    with ThreadPoolExecutor(max_workers=len(bands)) as pool:
+        results = list(pool.map(transcribe_band, range(1, len(bands) + 1), bands))
+    
+    usage = results[0]["usage"]
+    for result in results[1:]:
+        usage = add_usage(usage, result["usage"])
+    escalated = [result for result in results if result["tier"] == "escalated"]
+    return {
+        "transcription": stitch_transcriptions([result["transcription"] for result in results], tiling["overlap"]),
+        "usage": usage,
+        "continuations": sum(result["continuations"] for result in results),
+        "truncated": any(result["truncated"] for result in results),
+        "model": escalated[0]["model"] if escalated else results[0]["model"],
+        "tier": escalated[0]["tier"] if escalated else results[0]["tier"],
+        "escalation": escalated[0]["escalation"] if escalated else None,
+        "tiles": len(bands)
+    }
+
+# Transcribe one bulk page through the request executor, which retries failed calls with backoff.
+# Tall pages are tiled if tiling is enabled, and the model is chosen by the routing settings.
+# The source is anything open_page accepts, such as a path, an uploaded file or a document page.
+# With an ExampleSelector the history is chosen for the page from its training examples.
+def transcribe_with_backoff(source, prompt, history, client, executor, cache_history=False, preprocessing=None, blob_store=None, output_limits=None, tiling=None, routing=None, examples=None):
+    # A bulk page is not transcribed again once it is done, so its encodings are only kept
+    # for the retries and escalations of this page instead of in the process-wide cache
+    encoding_cache = EncodedImageCache(ENCODING_CACHE_MAX_BYTES)
+    
+    # The decoded page is released as soon as it has been transcribed
+    with open_page(source) as image:
+        if examples is not None:
+            history = examples.history(image)
+        if should_tile(image, tiling):
+            return transcribe_tiled(
+                image,
+                prompt,
+                history,
+                client,
+                tiling,
+                cache_history=cache_history,
+                preprocessing=preprocessing,
+                blob_store=blob_store,
+                output_limits=output_limits,
+                executor=executor,
+                routing=routing,
+                encoding_cache=encoding_cache
+            )
+        
+        return transcribe_routed(
+            image,
+            prompt,
+            history,
+            client,
+            routing,
+            call=executor.run,
+            cache_history=cache_history,
+            preprocessing=preprocessing,
+            blob_store=blob_store,
+            output_limits=output_limits,
+            encoding_cache=encoding_cache
+        )
+
+# Columns of the bulk result rows
+BULK_RESULT_FIELDS = [
+    "position",
+    "filename",
+    "page",
+    "transcription",
+    "continuations",
+    "truncated",
+    "model",
+    "tier",
+    "escalation",
+    "input_tokens",
+    "cache_read_tokens",
+    "cache_write_tokens",
+    "output_tokens"
+]
+
+# Build the result row stored for a bulk page, with the token counts of its call.
+# Pages of multi-page documents are labelled with their page number, and position is the
+# page's place in upload order, counted from 1.
+def bulk_result_row(filename, result, error=None, page=None, position=None):
+    if error is not None:
+        return {
+            "position": position,
+            "filename": filename,
+            "page": page,
+            "transcription": f"FEL: {str(error)}"
+        }
+    
+    usage = result["usage"]
+    return {
+        "position": position,
+        "filename": filename,
+        "page": page,
+        "transcription": result["transcription"],
+        "continuations": result.get("continuations", 0),
+        "truncated": result.get("truncated", False),
+        "model": result.get("model", MODEL),
+        "tier": result.get("tier", "single"),
+        "escalation": result.get("escalation"),
+        "input_tokens": usage["input_tokens"],
+        "cache_read_tokens": usage["cache_read_tokens"],
+        "cache_write_tokens": usage["cache_write_tokens"],
+        "output_tokens": usage["output_tokens"]
+    }
+
+# Names of the tiers and escalation reasons of routed pages, for summaries
+TIER_LABELS = {
+    "single": "vald modell",
+    "fast": "snabb modell",
+    "escalated": "eskalerade"
+}
+ESCALATION_LABELS = {
+    "truncated": "avkortade",
+    "uncertain": "osäkra ord",
+    "disagreement": "oeniga läsningar"
+}
+
+# Count a page result in per-tier statistics: pages per tier, and escalations per reason
+def count_tier(counts, result):
+    tier = result.get("tier", "single")
+    counts[tier] = counts.get(tier, 0) + 1
+    if result.get("escalation"):
+        counts[result["escalation"]] = counts.get(result["escalation"], 0) + 1
+
+# Describe per-tier statistics, for example "12 snabb modell, 3 eskalerade (2 osäkra ord, 1 avkortade)"
+def format_tier_counts(counts):
+    parts = [f"{counts[tier]} {label}" for tier, label in TIER_LABELS.items() if counts.get(tier)]
+    reasons = [f"{counts[reason]} {label}" for reason, label in ESCALATION_LABELS.items() if counts.get(reason)]
+    text = ", ".join(parts)
+    if reasons:
+        text += f" ({', '.join(reasons)})"
+    return text
+
+# Writes result rows to a JSON lines or CSV file as they arrive, flushing after every row,
+# so results survive an interrupted run and no rows are held in memory. Pages finish in
+# any order; the position column gives their upload order, see read_result_rows.
+class ResultWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8", newline="")
+        self.csv_writer = None
+        if path.lower().endswith(".csv"):
+            self.csv_writer = csv.DictWriter(self.file, fieldnames=BULK_RESULT_FIELDS, restval="")
+            self.csv_writer.writeheader()
+
+    def write(self, row):
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Read the rows of a result file written by ResultWriter in upload order. With a limit only
+# the first rows are returned, and only that many are held in memory while the file is read.
+# Rows without a position come last.
+def read_result_rows(path, limit=None):
+    def upload_order(numbered_row):
+        position = numbered_row[1].get("position")
+        return (position in (None, ""), int(position) if position not in (None, "") else 0, numbered_row[0])
+    
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        numbered_rows = enumerate(rows)
+        if limit is None:
+            ordered = sorted(numbered_rows, key=upload_order)
+        else:
+            ordered = heapq.nsmallest(limit, numbered_rows, key=upload_order)
+    return [row for _, row in ordered]
+
+# Default location of the job journal
+DEFAULT_JOURNAL_PATH = os.path.join(os.path.expanduser("~"), ".transcription", "journal.sqlite")
+
+# Persistent record of the status of every bulk page, written as each page finishes.
+# A restarted or re-submitted job skips the pages that are already done.
+class JobJournal:
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "page_key TEXT PRIMARY KEY, filename TEXT, status TEXT, result TEXT, updated_at TEXT)"
+            )
+
+    # Return the stored result of a finished page, or None if it has to be transcribed
+    def get_done(self, page_key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT result FROM pages WHERE page_key = ? AND status = 'done'", (page_key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record(self, page_key, filename, status, result):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, datetime('now'))",
+                (page_key, filename, status, json.dumps(result, ensure_ascii=False))
+            )
+
+    def close(self):
+        self.connection.close()
+
+# Hash the raw bytes of a page source (a path, a file-like object or a document page)
+def source_digest(source):
+    if isinstance(source, DocumentPage):
+        return hashlib.sha256(source.digest().encode("utf-8")).hexdigest()
+    
+    digest = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    else:
+        digest.update(source.getvalue())
+    return digest.hexdigest()
+
+# Fingerprint everything besides the page that affects a transcription.
+# The output limits are included, so pages cut off at a lower token limit are not reused.
+# With a history_key from history_fingerprint, the history is identified by it instead of
+# by its rendered messages.
+def job_fingerprint(prompt, history, preprocessing=None, tiling=None, routing=None, examples=None, output_limits=None, history_key=None):
+    routing = routing or DEFAULT_ROUTING
+    settings = {
+        "model": routing["model"],
+        "prompt": prompt,
+        "preprocessing": preprocessing or DEFAULT_PREPROCESSING,
+        "output_limits": output_limits or DEFAULT_OUTPUT_LIMITS,
+        "history": history if history_key is None else history_key
+    }
+    if tiling and tiling["enabled"]:
+        settings["tiling"] = tiling
+    if routing["cascade"]:
+        settings["routing"] = routing
+    if examples is not None:
+        settings["examples"] = examples.fingerprint
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+# The part of a page result that is stored in the journal
+def journal_result(result):
+    return {key: value for key, value in result.items() if key != "user_message"}
+
+# Key of a page in the job journal and the result cache: its content hash combined with the job fingerprint
+def page_key(digest, fingerprint):
+    return hashlib.sha256(f"{digest}:{fingerprint}".encode("utf-8")).hexdigest()
+
+# Default location and size cap of the result cache
+DEFAULT_RESULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".transcription", "results.sqlite")
+RESULT_CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+# Persistent cache of page results shared by all jobs, so a page that was already transcribed
+# with the same prompt, training context, preprocessing and model is not sent again.
+# The least recently used results are evicted once the stored results exceed max_bytes.
+class ResultCache:
+    def __init__(self, path=DEFAULT_RESULT_CACHE_PATH, max_bytes=RESULT_CACHE_MAX_BYTES):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "page_key TEXT PRIMARY KEY, result TEXT, size INTEGER, last_used REAL)"
+            )
+
+    def get(self, page_key):
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT result FROM results WHERE page_key = ?", (page_key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute(
+                "UPDATE results SET last_used = ? WHERE page_key = ?", (time.time(), page_key)
+            )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, page_key, result):
+        data = json.dumps(result, ensure_ascii=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (page_key, data, len(data.encode("utf-8")), time.time())
+            )
+            self.evict()
+
+    # Delete the least recently used results until the cache fits its size cap.
+    # Called with the lock held.
+    def evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.connection.execute("SELECT page_key, size FROM results ORDER BY last_used").fetchall()
+        for key, size in rows:
+            self.connection.execute("DELETE FROM results WHERE page_key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM results")
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "bytes": size
+            }
+
+    def close(self):
+        self.connection.close()
+
+# Look up a page in the job journal and the result cache before it is transcribed.
+# Returns the stored result marked "resumed" or "cached", or None if the page has to be transcribed.
+def stored_page_result(key, name, journal, result_cache):
+    if journal is not None:
+        done = journal.get_done(key)
+        if done is not None:
+            return {**done, "resumed": True}
+    if result_cache is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            if journal is not None:
+                journal.record(key, name, "done", cached)
+            return {**cached, "cached": True}
+    return None
+
+# Record a finished page in the job journal and the result cache.
+# Truncated results are only kept in the journal of their job, where a rerun with a higher
+# token limit gets a different page key; other jobs transcribe such pages anew.
+def store_page_result(key, name, result, journal, result_cache):
+    stored = journal_result(result)
+    if journal is not None:
+        journal.record(key, name, "done", stored)
+    if result_cache is not None and not result.get("truncated"):
+        result_cache.put(key, stored)
+
+# Transcribe pages concurrently and yield (index, result, error) as each page finishes.
+# Pages are (name, source) pairs from any iterable; exactly one of result and error is set.
+# Pages are taken from the iterable only as the prefetch window (twice the concurrency by
+# default) has room, and each page is decoded by its worker and released once it is done,
+# so memory use does not grow with the number of pages.
+# With a journal, pages already done are yielded with "resumed" set in their result,
+# and with a result cache, pages transcribed by earlier jobs are yielded with "cached" set.
+# Both find pages by a key that includes history_key, if given, instead of the rendered history.
+# With tiling enabled, tall pages are transcribed as bands within the same concurrency limit.
+# The model of each page is chosen by the routing settings, which may escalate it in a cascade.
+# Calls are made with the timeout, retries and circuit breaker of the retry policy; the SDK's
+# own retries are disabled so the executor controls the backoff. Pages that fail with a
+# retryable error are held back and, if the policy allows, tried again once all other pages
+# are done, so a passing overload does not leave them failed.
+# An executor can be given to share its concurrency limit and circuit breaker with other runs.
+# With an ExampleSelector every page gets its own history of the most similar training
+# iterations instead of the shared one.
+# Setting the cancel event stops the run from taking new pages: pages that have not started are
+# dropped, and the pages in flight are finished and yielded. When the run is closed early instead,
+# the pages in flight are finished and recorded in the journal and result cache.
+def run_bulk_transcription(pages, prompt, history, client, max_concurrency=4, cache_history=False, preprocessing=None, blob_store=None, output_limits=None, journal=None, result_cache=None, prefetch=None, tiling=None, retry_policy=None, executor=None, routing=None, examples=None, cancel=None, history_key=None):
+    if cancel is None:
+        cancel = threading.Event()
+    if retry_policy is None:
+        retry_policy = executor.policy if executor is not None else DEFAULT_RETRY_POLICY
+    client = client.with_options(max_retries=0, timeout=retry_policy["timeout"])
+    if executor is None:
+        executor = RequestExecutor(max_concurrency, retry_policy)
+    if prefetch is None:
+        prefetch = 2 * max_concurrency
+    track_pages = journal is not None or result_cache is not None
+    fingerprint = job_fingerprint(prompt, history, preprocessing, tiling, routing, examples, output_limits, history_key) if track_pages else None
+    
+    page_iterator = enumerate(pages)
+    exhausted = False
+    retrying = False
+    failed = []
+    pending = {}
+    pool = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        while True:
+            if cancel.is_set():
+                # Drop the pages that have not started; the ones in flight are still finished
+                for future in [future for future in pending if future.cancel()]:
+                    del pending[future]
+            
+            # Submit pages until the prefetch window is full
+            while not exhausted and not cancel.is_set() and len(pending) < prefetch:
+                try:
+                    i, (name, source) = next(page_iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                
+                key = None
+                if track_pages:
+                    key = page_key(source_digest(source), fingerprint)
+                    stored = stored_page_result(key, name, journal, result_cache)
+                    if stored is not None:
+                        yield i, stored, None
+                        continue
+                
+                future = pool.submit(
+                    transcribe_with_backoff,
+                    source,
+                    prompt,
+                    history,
+                    client,
+                    executor,
+                    cache_history=cache_history,
+                    preprocessing=preprocessing,
+                    blob_store=blob_store,
+                    output_limits=output_limits,
+                    tiling=tiling,
+                    routing=routing,
+                    examples=examples
+                )
+                pending[future] = (i, name, source, key)
+            
+            if not pending:
+                if retrying or not failed or cancel.is_set():
+                    break
+                
+                # Final pass over the pages that failed with retryable errors
+                logger.info("Försöker igen med %d sidor som misslyckades", len(failed))
+                page_iterator = iter(failed)
+                exhausted = False
+                retrying = True
+                continue
+            
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, name, source, key = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not retrying and not cancel.is_set() and retry_policy["retry_failed"] and is_retryable_error(e):
+                        failed.append((i, (name, source)))
+                        continue
+                    if journal is not None:
+                        journal.record(key, name, "failed", {"error": str(e)})
+                    yield i, None, e
+                    continue
+                
+                if track_pages:
+                    store_page_result(key, name, result, journal, result_cache)
+                yield i, result, None
+    finally:
+        # When the run is closed early, pages that have not started are dropped, and the pages
+        # in flight are recorded so a resumed job does not pay for them again
+        pool.shutdown(wait=True, cancel_futures=True)
+        if track_pages:
+            for future, (i, name, source, key) in pending.items():
+                if not future.cancelled() and future.exception() is None:
+                    store_page_result(key, name, future.result(), journal, result_cache)
+
+# Seconds between status checks of a submitted message batch
+BATCH_POLL_INTERVAL = 30
+
+# Upper bound for the request payload of a single message batch (the API accepts 256 MB)
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+
+# Continue a batch result that stopped at the token limit with regular calls, made through the
+# executor with its retries. The continuation calls are recorded in the metrics on their own,
+# at the regular price, since only the batch request itself is billed at the batch price.
+def continue_batch_message(client, executor, messages, message, output_limits, model=MODEL):
+    batch_usage = usage_summary(message)
+    payload = payload_bytes(messages)
+    
+    def attempt_continuation(attempt):
+        started = time.perf_counter()
+        try:
+            result = complete_transcription(client, messages, message, output_limits, model=model)
+        except Exception as e:
+            get_metrics().record(call_metrics("continuation", 0.0, payload, time.perf_counter() - started, None, attempt=attempt, error=e, model=model))
+            raise
+        if result["continuations"]:
+            get_metrics().record(call_metrics(
+                "continuation",
+                0.0,
+                payload,
+                time.perf_counter() - started,
+                {key: result["usage"][key] - batch_usage[key] for key in batch_usage},
+                api_calls=result["continuations"],
+                attempt=attempt,
+                model=model
+            ))
+        return result
+    
+    return executor.run(attempt_continuation)
+
+# Transcribe pages through the Message Batches API, which costs less than individual calls
+# but may take up to 24 hours. A batch is submitted as soon as its payload would exceed
+# BATCH_MAX_BYTES, so only one batch of requests is held in memory. All batches are polled until they have ended, then
+# (index, result, error) is yielded for every page like run_bulk_transcription does.
+# on_status is called with the list of batches after every poll. Pages cut off at the
+# token limit are continued with regular calls once their batch has ended, made with the
+# retry policy like in run_bulk_transcription (or through the given executor). A page whose
+# continuation still fails keeps the text of its batch result, marked as truncated.
+# Every page goes to the model of the routing settings; the cascade is not supported here.
+# With an ExampleSelector every page gets its own history, and the journal and result cache
+# use history_key, like in run_bulk_transcription.
+# Setting the cancel event stops the submission, cancels the submitted batches at Anthropic
+# and ends the run without results.
+def run_batch_transcription(pages, prompt, history, client, cache_history=False, preprocessing=None, blob_store=None, output_limits=None, journal=None, result_cache=None, poll_interval=BATCH_POLL_INTERVAL, on_status=None, routing=None, examples=None, cancel=None, retry_policy=None, executor=None, history_key=None):
+    if cancel is None:
+        cancel = threading.Event()
+    if retry_policy is None:
+        retry_policy = executor.policy if executor is not None else DEFAULT_RETRY_POLICY
+    if executor is None:
+        executor = RequestExecutor(1, retry_policy)
+    continuation_client = client.with_options(max_retries=0, timeout=retry_policy["timeout"])
+    if output_limits is None:
+        output_limits = DEFAULT_OUTPUT_LIMITS
+    if routing is None:
+        routing = DEFAULT_ROUTING
+    if routing["cascade"]:
+        raise ValueError("Kaskadläget stöds inte med Message Batches.")
+    model = routing["model"]
+    track_pages = journal is not None or result_cache is not None
+    fingerprint = job_fingerprint(prompt, history, preprocessing, routing=routing, examples=examples, output_limits=output_limits, history_key=history_key) if track_pages else None
+    page_keys = {}
+    
+    # Encode time and request size of every submitted page, for its metrics entry
+    page_requests = {}
+    
+    # The shared context is the same for every request, so its size is only measured once
+    def measure_context(history):
+        return len(json.dumps(resolve_blob_refs(history, blob_store) if blob_store is not None else history))
+    context_bytes = measure_context(history)
+    
+    # Each page is encoded once for its request, so the encodings are not cached at all
+    no_encoding_cache = EncodedImageCache(0)
+    
+    batches = []
+    chunk = []
+    chunk_bytes = 0
+    for i, (name, source) in enumerate(pages):
+        if cancel.is_set():
+            break
+        if track_pages:
+            page_keys[i] = page_key(source_digest(source), fingerprint)
+            stored = stored_page_result(page_keys[i], name, journal, result_cache)
+            if stored is not None:
+                yield i, stored, None
+                continue
+        
+        started = time.perf_counter()
+        page_context_bytes = context_bytes
+        with open_page(source) as image:
+            page_history = history
+            if examples is not None:
+                page_history = examples.history(image)
+                page_context_bytes = measure_context(page_history)
+            messages, user_message = build_transcription_messages(
+                image,
+                prompt,
+                page_history,
+                cache_history=cache_history,
+                preprocessing=preprocessing,
+                blob_store=blob_store,
+                encoding_cache=no_encoding_cache
+            )
+        request_bytes = page_context_bytes + len(user_message["content"][0]["source"]["data"])
+        page_requests[i] = (time.perf_counter() - started, request_bytes)
+        if chunk and chunk_bytes + request_bytes > BATCH_MAX_BYTES:
+            batches.append(client.messages.batches.create(requests=chunk))
+            chunk = []
+            chunk_bytes = 0
+        chunk.append({
+            "custom_id": f"page-{i}",
+            "params": {
+                "model": model,
+                "max_tokens": output_limits["max_tokens"],
+                "messages": messages
+            }
+        })
+        chunk_bytes += request_bytes
+    
+    if chunk and not cancel.is_set():
+        batches.append(client.messages.batches.create(requests=chunk))
+    
+    # Wait for every batch to end, waking up early if the run is cancelled
+    while not cancel.is_set():
+        batches = [client.messages.batches.retrieve(batch.id) for batch in batches]
+        if on_status is not None:
+            on_status(batches)
+        if all(batch.processing_status == "ended" for batch in batches):
+            break
+        cancel.wait(poll_interval)
+    
+    if cancel.is_set():
+        for batch in batches:
+            if batch.processing_status != "ended":
+                client.messages.batches.cancel(batch.id)
+        logger.info("Batchkörningen avbröts, %d batcher avbryts hos Anthropic", len(batches))
+        return
+    
+    for batch in batches:
+        for entry in client.messages.batches.results(batch.id):
+            i = int(entry.custom_id.split("-", 1)[1])
+            if entry.result.type == "succeeded":
+                message = entry.result.message
+                get_metrics().record(call_metrics(
+                    "batch",
+                    *page_requests[i],
+                    None,
+                    usage_summary(message),
+                    batch=True,
+                    model=model
+                ))
+                result = {
+                    "transcription": response_text(message),
+                    "usage": usage_summary(message),
+                    "continuations": 0,
+                    "truncated": message.stop_reason == "max_tokens"
+                }
+                if result["truncated"] and output_limits["max_continuations"] > 0:
+                    try:
+                        with open_page(pages[i][1]) as image:
+                            messages, _ = build_transcription_messages(
+                                image,
+                                prompt,
+                                examples.history(image) if examples is not None else history,
+                                cache_history=cache_history,
+                                preprocessing=preprocessing,
+                                blob_store=blob_store,
+                                encoding_cache=no_encoding_cache
+                            )
+                        result = continue_batch_message(continuation_client, executor, messages, message, output_limits, model)
+                    except Exception as e:
+                        # The batch result is already paid for, so it is kept even though it is cut off
+                        logger.warning("Kunde inte fortsätta den avkortade sidan %s: %s", pages[i][0], e)
+                result.update({"model": model, "tier": "single", "escalation": None})
+                if track_pages:
+                    store_page_result(page_keys[i], pages[i][0], result, journal, result_cache)
+                yield i, result, None
+            else:
+                error = getattr(entry.result, "error", None)
+                message = f"Batchförfrågan {entry.result.type}" + (f": {error.error.message}" if error is not None else "")
+                get_metrics().record(call_metrics("batch", *page_requests[i], None, None, error=RuntimeError(message), batch=True, model=model))
+                if journal is not None:
+                    journal.record(page_keys[i], pages[i][0], "failed", {"error": message})
+                yield i, None, RuntimeError(message)
+
+# Upper bound for the API calls in flight across all jobs of a job queue
+JOB_QUEUE_MAX_CONCURRENCY = 8
+
+# Number of jobs a job queue runs at the same time; further jobs wait in line
+JOB_QUEUE_MAX_RUNNING_JOBS = 2
+
+# Seconds a finished job and its result file are kept before the job queue removes them
+JOB_QUEUE_FINISHED_JOB_TTL = 24 * 60 * 60
+
+# Seconds between the job queue's checks for expired jobs
+JOB_QUEUE_EXPIRY_INTERVAL = 60
+
+# A bulk job in a job queue. run is called with the job and a request executor when the job
+# starts and returns the (index, result, error) iterator of a bulk run over pages; it can set
+# detail to describe what the run is waiting for. Rows are written to results_path as CSV,
+# and the progress counters can be read from other threads while the job runs.
+# A remote job spends its time waiting for work done by Anthropic, such as a message batch.
+# Runs should stop taking pages when cancel_event is set; the rows of pages they still
+# yield, such as those already in flight, are written before the job ends as cancelled.
+class BulkJob:
+    def __init__(self, job_id, owner, pages, run, results_path, retry_policy=None, remote=False):
+        self.id = job_id
+        self.owner = owner
+        self.pages = pages
+        self.total = len(pages)
+        self.run = run
+        self.results_path = results_path
+        self.retry_policy = retry_policy
+        self.remote = remote
+        self.status = "queued"
+        self.completed = 0
+        self.failures = 0
+        self.resumed = 0
+        self.cached = 0
+        self.tiers = {}
+        self.last_label = None
+        self.detail = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.submitted_at = time.time()
+        self.finished_at = None
+
+    @property
+    def cancel_requested(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+# Process-wide queue of bulk jobs, shared by every user of a server. Jobs are run by a fixed
+# number of worker threads, taking turns between owners so one user's long queue does not
+# hold back the others, and at most one job per owner runs at a time. All jobs make their
+# API calls through one concurrency limiter and circuit breaker, so the total load on the
+# API stays within max_concurrency however many jobs are running.
+# Remote jobs start right away on a thread of their own instead: they may wait for up to a
+# day and make few calls, so they should not hold one of the workers.
+# Finished jobs are removed together with their result files when they are forgotten, or
+# finished_job_ttl seconds after they finished, so jobs left behind by closed sessions do not
+# pile up on a long-running server.
+class JobQueue:
+    def __init__(self, max_concurrency=JOB_QUEUE_MAX_CONCURRENCY, max_running_jobs=JOB_QUEUE_MAX_RUNNING_JOBS, finished_job_ttl=JOB_QUEUE_FINISHED_JOB_TTL):
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+        self.breaker = CircuitBreaker(DEFAULT_RETRY_POLICY["breaker_threshold"], DEFAULT_RETRY_POLICY["breaker_cooldown"])
+        self.jobs = {}
+        self.queued = OrderedDict()
+        self.running_owners = set()
+        self.next_id = 1
+        self.finished_job_ttl = finished_job_ttl
+        self.condition = threading.Condition()
+        for _ in range(max_running_jobs):
+            threading.Thread(target=self.work, daemon=True).start()
+        threading.Thread(target=self.expire_jobs, daemon=True).start()
+
+    # A request executor that shares the queue's concurrency limit and circuit breaker
+    def request_executor(self, retry_policy=None):
+        return RequestExecutor(self.limiter.max_concurrency, retry_policy, self.limiter, self.breaker)
+
+    def submit(self, owner, pages, run, results_path, retry_policy=None, remote=False):
+        with self.condition:
+            job = BulkJob(self.next_id, owner, pages, run, results_path, retry_policy, remote)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            if remote:
+                job.status = "running"
+                threading.Thread(target=self.run_job, args=(job,), daemon=True).start()
+            else:
+                self.queued.setdefault(owner, deque()).append(job)
+                self.condition.notify_all()
+        return job
+
+    # The jobs of an owner, oldest first
+    def owner_jobs(self, owner):
+        with self.condition:
+            return [job for job in self.jobs.values() if job.owner == owner]
+
+    # Number of jobs waiting to start, across all owners
+    def queued_count(self):
+        with self.condition:
+            return sum(len(jobs) for jobs in self.queued.values())
+
+    # Stop a job: a queued job is dropped, a running job stops taking new pages and finishes
+    # the ones in flight, and a remote job stops waiting
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.jobs[job_id]
+            job.cancel_event.set()
+            jobs = self.queued.get(job.owner)
+            if jobs and job in jobs:
+                jobs.remove(job)
+                if not jobs:
+                    del self.queued[job.owner]
+                job.status = "cancelled"
+                job.finished_at = time.time()
+                job.pages = job.run = None
+
+    # Drop a finished job from the queue and delete its result file
+    def forget(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or not job.finished:
+                return
+            del self.jobs[job_id]
+        if os.path.exists(job.results_path):
+            os.remove(job.results_path)
+
+    # Forget the jobs that finished more than finished_job_ttl seconds ago
+    def forget_expired(self):
+        cutoff = time.time() - self.finished_job_ttl
+        with self.condition:
+            expired = [
+                job.id for job in self.jobs.values()
+                if job.finished and job.finished_at is not None and job.finished_at <= cutoff
+            ]
+        for job_id in expired:
+            self.forget(job_id)
+        if expired:
+            logger.info("%d avslutade jobb togs bort efter att ha legat kvar för länge", len(expired))
+
+    def expire_jobs(self):
+        while True:
+            time.sleep(JOB_QUEUE_EXPIRY_INTERVAL)
+            try:
+                self.forget_expired()
+            except Exception:
+                logger.exception("Kunde inte ta bort gamla jobb")
+
+    # Take the next job, going round the owners that have no job running
+    def next_job(self):
+        with self.condition:
+            while True:
+                for owner, jobs in self.queued.items():
+                    if owner in self.running_owners:
+                        continue
+                    job = jobs.popleft()
+                    if jobs:
+                        self.queued.move_to_end(owner)
+                    else:
+                        del self.queued[owner]
+                    self.running_owners.add(owner)
+                    job.status = "running"
+                    return job
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            try:
+                self.run_job(job)
+            finally:
+                with self.condition:
+                    self.running_owners.discard(job.owner)
+                    self.condition.notify_all()
+
+    def run_job(self, job):
+        writer = ResultWriter(job.results_path)
+        try:
+            for i, result, error in job.run(job, self.request_executor(job.retry_policy)):
+                name, source = job.pages[i]
+                writer.write(bulk_result_row(name, result, error, page_number(source), i + 1))
+                job.completed += 1
+                job.last_label = page_label(name, source)
+                if error is not None:
+                    job.failures += 1
+                else:
+                    count_tier(job.tiers, result)
+                    if result.get("resumed"):
+                        job.resumed += 1
+                    elif result.get("cached"):
+                        job.cached += 1
+            job.status = "cancelled" if job.cancel_requested else "done"
+        except Exception as e:
+            logger.exception("Jobb %d misslyckades", job.id)
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            writer.close()
+            job.finished_at = time.time()
+            # The pages and settings are not needed any more, only the counters and the result file
+            job.pages = job.run = None